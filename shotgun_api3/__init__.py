@@ -1,3 +1,6 @@
-from shotgun import (Shotgun, ShotgunError, Fault, ProtocolError, ResponseError,
-                     Error)
+from shotgun import (Shotgun, AsyncShotgun, EventStream, EventCacheInvalidator,
+                     Replica, RetryPolicy, CircuitBreaker, RateLimiter,
+                     ThumbnailUrl,
+                     ShotgunError, Fault, CallTimeoutError, CircuitOpenError,
+                     ProtocolError, ResponseError, Error)
 from shotgun import SG_TIMEZONE as sg_timezone
@@ -31,27 +31,42 @@
 
 
 import base64
+import calendar
 import cookielib    # used for attachment upload
+import copy
+import cPickle      # used for the replica records
 import cStringIO    # used for attachment upload
 import datetime
+import errno
+import httplib
 import logging
 import mimetools    # used for attachment upload
 import mimetypes    # used for attachment upload
 import os
+import Queue
+import random
 import re
+import select
+import socket
 import stat         # used for attachment upload
 import sys
+import threading
 import time
 import urllib
 import urllib2      # used for image upload
 import urlparse
-from lib.httplib2 import Http
+from lib.httplib2 import Http, HttpLib2Error, ServerNotFoundError
 from lib.sgtimezone import SgTimezone
 from lib.xmlrpclib import Error, ProtocolError, ResponseError
 
 LOG = logging.getLogger("shotgun_api3")
 SG_TIMEZONE = SgTimezone()
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 try:
     import simplejson as json
 except ImportError:
@@ -65,6 +80,12 @@ except ImportError:
         import lib.simplejson as json
         sys.path.pop()
 
+try:
+    import sqlite3
+except ImportError:
+    # python 2.4, the Replica is not available
+    sqlite3 = None
+
 # ----------------------------------------------------------------------------
 # Version
 __version__ = "3.0.8"
@@ -79,6 +100,15 @@ class ShotgunError(Exception):
 class Fault(ShotgunError):
     """Exception when server side exception detected."""
     pass
+
+class CallTimeoutError(ShotgunError):
+    """Exception when a call does not finish within its timeout."""
+    pass
+
+class CircuitOpenError(ShotgunError):
+    """Exception when a call is not made because the server is failing, see
+    CircuitBreaker."""
+    pass
     
 # ----------------------------------------------------------------------------
 # API
@@ -164,10 +194,74 @@ class _Config(object):
 
     def __init__(self):
         self.max_rpc_attempts = 3
+        # when and how long to wait before a failed request is repeated
+        self.retry_policy = RetryPolicy()
+        # CircuitBreaker that stops calls while the server is failing, it 
+        # may be shared by several clients
+        self.circuit_breaker = None
+        # RateLimiter for the requests to the server, it may be shared by 
+        # several clients
+        self.rate_limiter = None
         self.timeout_secs = None
         self.api_ver = 'api3'
         self.convert_datetimes_to_utc = True
         self.records_per_page = 500
+        # number of pages find() may read at once, 1 reads them in turn
+        self.max_parallel_pages = 1
+        # number of pages find_iter() reads ahead of the caller
+        self.prefetch_pages = 0
+        # tune the entities per page for each entity type and set of fields
+        # from the time taken and bytes returned for each page
+        self.adaptive_paging = False
+        self.target_page_secs = 2.0
+        self.target_page_bytes = None
+        self.min_records_per_page = 50
+        self.max_records_per_page = 500
+        # number of queries find_many() runs at once
+        self.max_concurrent_queries = 4
+        # maximum number of connections to the server, shared by all threads
+        self.connection_pool_size = 10
+        # seconds to wait for a free connection, None waits forever
+        self.connection_pool_timeout = None
+        # idle connections are closed after this many seconds
+        self.connection_idle_secs = 60
+        # number of thumbnail urls looked up at once when parsing records
+        self.max_thumbnail_workers = 8
+        # seconds thumbnail urls are cached for, 0 does not cache them and 
+        # None caches them until the client changes the thumbnail
+        self.thumbnail_cache_secs = 0
+        self.thumbnail_cache_size = 10000
+        # if True the image field is a ThumbnailUrl that looks up the url
+        # the first time it is used
+        self.lazy_thumbnails = False
+        # cache the results of read and summarize calls
+        self.cache_results = False
+        self.cache_ttl_secs = 60
+        # entity type to the seconds results for that type are cached for
+        self.cache_ttls = {}
+        # seconds an expired result may still be returned for while it is 
+        # read again in the background, 0 waits for the new result
+        self.cache_stale_secs = 0
+        # entity type to the seconds expired results for that type are used
+        self.cache_stale_ttls = {}
+        # seconds find_one() remembers that nothing matched, 0 disables it
+        self.cache_misses_secs = 0
+        self.cache_max_entries = 1000
+        self.cache_max_bytes = 50 * 1024 * 1024
+        # directory for caches shared by processes, None disables them
+        self.cache_dir = None
+        # seconds the server info is cached for in cache_dir
+        self.server_caps_cache_secs = 3600
+        # cache the results of schema reads for the server version, also in 
+        # cache_dir if it is set
+        self.cache_schema = False
+        self.schema_cache_secs = 3600
+        # identical read calls made at the same time share one request
+        self.coalesce_reads = True
+        # send a second request for a read that has not returned within the
+        # hedge_percentile of the recent latency for the rpc method
+        self.hedge_reads = False
+        self.hedge_percentile = 95
         self.api_key = None
         self.script_name = None
         # uuid as a string
@@ -180,6 +274,465 @@ class _Config(object):
         self.session_token = None
         self.authorization = None
         
+class RetryPolicy(object):
+    """Decides which failed requests to the server are repeated, and how long
+    to wait before each attempt. 
+    
+    A request is repeated if the error is one that may pass, such as a 
+    network error, timeout or a 502, 503 or 504 status. Calls that change 
+    data, such as create and batch, are only repeated if the request did not
+    reach the server. 
+    
+    The wait grows exponentially from backoff_secs up to max_backoff_secs, 
+    and a random part of it is used so clients that failed together do not 
+    retry together. 
+    
+    Each client has a budget of retries so a server that is down is not 
+    flooded with them. The budget starts at budget and every request that 
+    is not a retry adds budget_ratio to it, up to budget. Each retry spends 
+    one. 
+    """
+    
+    RETRY_STATUSES = (502, 503, 504)
+    
+    # rpc methods that have the same effect if they are repeated
+    IDEMPOTENT_METHODS = ("info", "read", "summarize", "schema_read", 
+        "schema_entity_read", "schema_field_read", "update", 
+        "schema_field_update")
+    
+    # socket errors raised before the request is sent
+    NOT_SENT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, 
+        errno.ENETUNREACH)
+    
+    RETRY_ERRNOS = NOT_SENT_ERRNOS + (errno.ECONNRESET, errno.ECONNABORTED, 
+        errno.EPIPE, errno.ETIMEDOUT)
+    
+    def __init__(self, backoff_secs=0.5, max_backoff_secs=30, budget=20, 
+        budget_ratio=0.1):
+        """RetryPolicy.__init__
+        
+        :param backoff_secs: Optional, most seconds to wait before the first 
+        retry.
+        
+        :param max_backoff_secs: Optional, most seconds to wait before any 
+        retry. 
+        
+        :param budget: Optional, most retries that can be made without 
+        requests that are not retries in between. 
+        
+        :param budget_ratio: Optional, retries earned by each request that is
+        not a retry. 
+        """
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self._tokens = float(budget)
+        self._lock = threading.Lock()
+    
+    def is_retryable(self, verb, method, error=None, status=None):
+        """Returns True if a request that failed can be repeated.
+        
+        :param verb: HTTP verb of the request. 
+        
+        :param method: rpc method called, None if the request is not an rpc 
+        call. 
+        
+        :param error: Exception raised making the request. 
+        
+        :param status: HTTP status code of the response. 
+        """
+        idempotent = verb == "GET" or method in self.IDEMPOTENT_METHODS
+        if status is not None:
+            return idempotent and status in self.RETRY_STATUSES
+        if error is None:
+            return False
+        if not idempotent:
+            return self._not_sent(error)
+        if isinstance(error, socket.error) and \
+            not isinstance(error, socket.timeout):
+            return _errno(error) in self.RETRY_ERRNOS
+        return _transport_error(error)
+    
+    def backoff(self, attempt):
+        """Returns the seconds to wait before repeating a request that failed
+        on attempt, counting from 1."""
+        limit = min(self.max_backoff_secs, 
+            self.backoff_secs * (2 ** (attempt - 1)))
+        return random.uniform(0, limit)
+    
+    def record_request(self):
+        """Adds to the retry budget for a request that is not a retry."""
+        self._lock.acquire()
+        try:
+            self._tokens = min(self.budget, self._tokens + self.budget_ratio)
+        finally:
+            self._lock.release()
+    
+    def spend_retry(self):
+        """Spends one retry from the budget. 
+        
+        :returns: False if the budget is used up. 
+        """
+        self._lock.acquire()
+        try:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+        finally:
+            self._lock.release()
+    
+    def _not_sent(self, error):
+        if isinstance(error, ServerNotFoundError):
+            return True
+        return isinstance(error, socket.error) and \
+            _errno(error) in self.NOT_SENT_ERRNOS
+
+class CircuitBreaker(object):
+    """Stops calls to the server once it keeps failing, so callers fail at 
+    once rather than waiting for each call to time out. 
+    
+    The circuit opens after failure_threshold requests in a row fail with a 
+    network error or a 502, 503 or 504 status. While it is open requests 
+    raise CircuitOpenError. After reset_secs one request is let through, if 
+    it succeeds the circuit closes, otherwise it opens for another 
+    reset_secs. If it is not sent, or fails before the server answers, the 
+    next request is let through instead. 
+    
+    One breaker can be used by many clients and threads. If state_path is 
+    given the open or closed state is also shared with other processes 
+    through that file, the failures that open the circuit are counted by 
+    each process. 
+    
+    e.g. 
+    sg.config.circuit_breaker = CircuitBreaker(state_path="/tmp/sg.circuit")
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold=5, reset_secs=30, state_path=None):
+        """CircuitBreaker.__init__
+        
+        :param failure_threshold: Optional, number of failed requests in a 
+        row that open the circuit. 
+        
+        :param reset_secs: Optional, seconds the circuit stays open before a
+        request is tried. 
+        
+        :param state_path: Optional, path of the file to share the state 
+        with other processes in. 
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.state_path = state_path
+        self.state = self.CLOSED
+        self.failures = 0
+        # time the circuit opened, or the half open request started
+        self.changed_at = None
+        # version of the state in state_path, and the process that wrote it
+        self._state_version = None
+        self._lock = threading.Lock()
+    
+    def before_request(self):
+        """Checks a request can be made. 
+        
+        :returns: True if the request is to test the server, if it is not 
+        sent or gets no response record_skipped() must be called. 
+        
+        :raises CircuitOpenError: If the circuit is open, or half open and 
+        the request to test the server is in flight. 
+        """
+        self._lock.acquire()
+        try:
+            self._load()
+            if self.state == self.CLOSED:
+                return False
+            wait = self.changed_at + self.reset_secs - time.time()
+            if wait <= 0:
+                # this request tests the server, the others wait for it
+                self._change(self.HALF_OPEN)
+                return True
+            raise CircuitOpenError("Calls to the server have been failing, "\
+                "not calling it for another %.0f secs" % (wait,))
+        finally:
+            self._lock.release()
+    
+    def record_success(self):
+        """Records a request that reached the server."""
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                LOG.info("Calls to the server are working, closing circuit")
+                self._change(self.CLOSED)
+        finally:
+            self._lock.release()
+    
+    def record_skipped(self):
+        """Records the request to test the server was not sent, or failed 
+        without a response from the server, so the next request tests it."""
+        self._lock.acquire()
+        try:
+            if self.state == self.HALF_OPEN:
+                self._change(self.OPEN, time.time() - self.reset_secs)
+        finally:
+            self._lock.release()
+    
+    def record_failure(self):
+        """Records a request that failed because of the network or server."""
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                self.failures >= self.failure_threshold):
+                LOG.warning("Calls to the server are failing, opening "\
+                    "circuit for %s secs" % (self.reset_secs,))
+                self._change(self.OPEN)
+        finally:
+            self._lock.release()
+    
+    def _change(self, state, changed_at=None):
+        self.state = state
+        self.changed_at = changed_at or time.time()
+        if not self.state_path:
+            return
+        version = [(self._state_version or [0])[0] + 1, os.getpid()]
+        try:
+            _write_file_atomic(self.state_path, json.dumps({"state" : state, 
+                "changed_at" : self.changed_at, "version" : version}))
+            self._state_version = version
+        except (IOError, OSError), e:
+            LOG.warning("Cannot write circuit state to %s: %s" % (
+                self.state_path, e))
+    
+    def _load(self):
+        """Reads the state from state_path if another process changed it."""
+        if not self.state_path:
+            return
+        try:
+            f = open(self.state_path, "rb")
+            try:
+                data = json.loads(f.read())
+            finally:
+                f.close()
+            if data["version"] == self._state_version:
+                return
+            self._state_version = data["version"]
+            self.state = data["state"]
+            self.changed_at = data["changed_at"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return
+
+class RateLimiter(object):
+    """Limits the requests a client makes to the server, by the rate they 
+    are started and the number in flight at once. 
+    
+    The rate uses a token bucket, up to burst requests can start at once 
+    and then they start at rate per second. When the limit is reached 
+    requests wait for their turn. 
+    
+    With adaptive set the limits follow the server: they are halved when a 
+    request is throttled (a 429 or 503 status), times out, or takes longer 
+    than target_latency_secs, and grow by about one each round trip while 
+    requests succeed, up to rate and max_in_flight. If target_latency_secs 
+    is None latency above twice the lowest recent latency counts as slow. 
+    
+    One limiter can be shared by several clients, e.g. 
+    limiter = RateLimiter(rate=20, max_in_flight=8, adaptive=True)
+    sg.config.rate_limiter = limiter
+    """
+    
+    THROTTLE_STATUSES = (429, 503)
+    
+    def __init__(self, rate=None, burst=None, max_in_flight=None, 
+        adaptive=False, target_latency_secs=None):
+        """RateLimiter.__init__
+        
+        :param rate: Optional, most requests started per second. Defaults to 
+        no limit. 
+        
+        :param burst: Optional, most requests started at once before the rate
+        applies. Defaults to rate. 
+        
+        :param max_in_flight: Optional, most requests in flight at once. 
+        Defaults to no limit. 
+        
+        :param adaptive: Optional, if True lower the limits while the server
+        is overloaded. 
+        
+        :param target_latency_secs: Optional, adaptive mode treats requests 
+        slower than this as a sign of overload. 
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or (rate and max(1, rate)) or None
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.adaptive = adaptive
+        self.target_latency_secs = target_latency_secs
+        self.in_flight = 0
+        self._tokens = float(self.burst or 0)
+        self._refilled_at = time.time()
+        self._min_latency = None
+        self._decreased_at = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self, timeout=None):
+        """Waits until a request can be made, it must be followed by 
+        release(). 
+        
+        :param timeout: Optional, most seconds to wait. Defaults to waiting 
+        until the request can be made. 
+        
+        :returns: False if the request cannot be made within the timeout, 
+        release() must not be called.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                # a slot is freed by release(), a token comes after wait
+                wait = None
+                if self.limit and self.in_flight >= int(self.limit):
+                    wait = 1.0
+                    token_due = False
+                elif self.rate:
+                    now = time.time()
+                    self._tokens = min(self.burst, self._tokens + 
+                        (now - self._refilled_at) * self.rate)
+                    self._refilled_at = now
+                    if self._tokens < 1:
+                        wait = (1 - self._tokens) / self.rate
+                        token_due = True
+                if wait is None:
+                    break
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or (token_due and wait > remaining):
+                        return False
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+            if self.rate:
+                self._tokens -= 1
+            self.in_flight += 1
+            return True
+        finally:
+            self._cond.release()
+    
+    def release(self, latency, status=None, error=None):
+        """Records a request has finished. 
+        
+        :param latency: Seconds the request took. 
+        
+        :param status: HTTP status code of the response. 
+        
+        :param error: Exception raised making the request. 
+        """
+        self._cond.acquire()
+        try:
+            self.in_flight -= 1
+            if self.adaptive:
+                if self._overloaded(latency, status, error):
+                    self._decrease(latency)
+                elif status is not None and status < 400:
+                    self._increase()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+    
+    def _overloaded(self, latency, status, error):
+        if status in self.THROTTLE_STATUSES or \
+            isinstance(error, socket.timeout):
+            return True
+        if self.target_latency_secs is not None:
+            return latency > self.target_latency_secs
+        # the lowest latency seen slowly rises so it follows the server, but
+        # not above the latency seen
+        if self._min_latency is None or latency < self._min_latency:
+            self._min_latency = latency
+        else:
+            self._min_latency = min(self._min_latency * 1.01, latency)
+        return latency > 2 * self._min_latency
+    
+    def _decrease(self, latency):
+        """Halves the limits, at most once a round trip as the requests in 
+        flight were all started at the old limits."""
+        now = time.time()
+        if now - self._decreased_at < latency:
+            return
+        self._decreased_at = now
+        if self.limit:
+            self.limit = max(1.0, self.limit / 2.0)
+        if self.rate:
+            self.rate = max(self.max_rate / 100.0, self.rate / 2.0)
+            self._tokens = min(self._tokens, 1.0)
+        LOG.debug("Server is overloaded, limits lowered to %s requests in "\
+            "flight and %s requests per second" % (self.limit, self.rate))
+    
+    def _increase(self):
+        if self.limit:
+            self.limit = min(self.max_in_flight, 
+                self.limit + 1.0 / self.limit)
+        if self.rate:
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+def _set_timeout(http, timeout):
+    """Sets the socket timeout of a httplib2 Http object and its open 
+    connections."""
+    http.timeout = timeout
+    for conn in http.connections.values():
+        conn.timeout = timeout
+        if getattr(conn, "sock", None) is not None:
+            conn.sock.settimeout(timeout)
+
+def _transport_error(error):
+    """Returns True if the error is from the network or the HTTP connection,
+    rather than from making the request."""
+    return isinstance(error, (HttpLib2Error, httplib.HTTPException, 
+        socket.error))
+
+def _errno(error):
+    """Returns the errno of a socket error, or None."""
+    if getattr(error, "errno", None) is not None:
+        return error.errno
+    if isinstance(error.args, tuple) and error.args and \
+        isinstance(error.args[0], int):
+        return error.args[0]
+    return None
+
+def _timeout_method(func):
+    """Adds timeout and deadline keyword arguments to a Shotgun method. 
+    
+    The deadline is kept for the thread while the method runs, so all of 
+    the requests it makes, and their retries, must finish in time. A 
+    timeout inside a call with an earlier deadline is shortened to it.
+    """
+    def _method(self, *args, **kwargs):
+        timeout = kwargs.pop("timeout", None)
+        deadline = kwargs.pop("deadline", None)
+        if timeout is None and deadline is None:
+            return func(self, *args, **kwargs)
+        state = self._thread_state
+        outer = getattr(state, "deadline", None)
+        if timeout is not None:
+            end = time.time() + timeout
+            if deadline is None or end < deadline:
+                deadline = end
+        if outer is not None:
+            deadline = min(deadline, outer)
+        state.deadline = deadline
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            state.deadline = outer
+    _method.__name__ = func.__name__
+    _method.__doc__ = func.__doc__
+    _method.__module__ = func.__module__
+    return _method
+
 class Shotgun(object):
     """Shotgun Client Connection"""
 
@@ -199,7 +752,8 @@ class Shotgun(object):
                  convert_datetimes_to_utc=True,
                  http_proxy=None,
                  ensure_ascii=True,
-                 connect=True):
+                 connect=True,
+                 cache_dir=None):
         """Initialises a new instance of the Shotgun client.
         
         :param base_url: http or https url to the shotgun server.
@@ -220,13 +774,34 @@ class Shotgun(object):
         form http://proxy.com:8080 
 
         :param connect: If True, connect to the server. Only used for testing.
+        
+        :param cache_dir: Optional, directory to cache server information in,
+        shared between processes. When the server info is cached the client 
+        does not need to call the server when it is created. See 
+        config.cache_dir.
         """
         self.config = _Config()
         self.config.api_key = api_key
         self.config.script_name = script_name
         self.config.convert_datetimes_to_utc = convert_datetimes_to_utc
         self.config.proxy_info = http_proxy
-        self._connection = None
+        self.config.cache_dir = cache_dir
+        self._connection_pool = _ConnectionPool(self._new_connection, 
+            self.config)
+        self._thread_state = threading.local()
+        self._page_sizer = _PageSizer(self.config)
+        self._thumb_urls = _LRUCache(lambda: self.config.thumbnail_cache_size)
+        self._result_cache = _LRUCache(
+            lambda: self.config.cache_max_entries, 
+            max_bytes=lambda: self.config.cache_max_bytes)
+        self._schema_cache = _LRUCache()
+        self._miss_cache = _LRUCache(lambda: self.config.cache_max_entries)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._revalidating = set()
+        self._latencies = _LatencyTracker()
+        self._hedge_workers = _WorkerPool(self, 
+            self.config.connection_pool_size)
         
         self.base_url = (base_url or "").lower()
         self.config.scheme, self.config.server, api_base, _, _ = \
@@ -255,6 +830,7 @@ class Shotgun(object):
         
         self.client_caps = ClientCapabilities()
         self._server_caps = None
+        self._server_caps_cached = False
         #test to ensure the the server supports the json API
         #call to server will only be made once and will raise error
         if connect:
@@ -276,8 +852,16 @@ class Shotgun(object):
         """
         if not self._server_caps or (
             self._server_caps.host != self.config.server):
+            # server info cached by another client is trusted until a call
+            # to the server fails, see _call_rpc()
+            meta = self._read_cache_file(self._server_info_file_name(), 
+                self.config.server_caps_cache_secs)
+            self._server_caps_cached = meta is not None
+            if meta is None:
+                meta = self.info()
+                self._write_cache_file(self._server_info_file_name(), meta)
             self._server_caps =  ServerCapabilities(self.config.server, 
-                self.info())
+                meta)
         return self._server_caps
         
     def connect(self):
@@ -287,25 +871,34 @@ class Shotgun(object):
         NOTE: The client will automatically connect to the server. Only 
         call this function if you wish to confirm the client can connect. 
         """
-        self._get_connection()
+        self._release_connection(self._get_connection())
         self.info()
         return
         
     def close(self):
-        """Closes the current connection to the server.
+        """Closes the idle connections to the server.
         
         If the client needs to connect again it will do so automatically.
         """
         self._close_connection()
         return
         
+    @_timeout_method
     def info(self):
         """Calls the Info function on the Shotgun API to get the server meta.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: dict of the server meta data.
         """
         return self._call_rpc("info", None, include_script_name=False)
 
+    @_timeout_method
     def find_one(self, entity_type, filters, fields=None, order=None, 
         filter_operator=None, retired_only=False):
         """Calls the find() method and returns the first result, or None.
@@ -332,17 +925,48 @@ class Shotgun(object):
         :param retired_only: Optional, flag to return only entities that have 
         been retried. Defaults to False which returns only entities which 
         have not been retired. 
+        
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
+        If config.cache_misses_secs is set, a query that matches nothing 
+        returns None without calling the server for that many seconds, or 
+        until this client changes an entity of the type. 
         """
         
+        miss_key = None
+        if self.config.cache_misses_secs:
+            wire = json.dumps(self._transform_outbound([entity_type, filters,
+                fields, order, filter_operator, retired_only]), 
+                sort_keys=True)
+            if isinstance(wire, unicode):
+                wire = wire.encode("utf-8")
+            miss_key = sha1(wire).hexdigest()
+            if self._miss_cache.get(miss_key):
+                LOG.debug("Using cached miss for find_one on %s" % (
+                    entity_type))
+                return None
+            generation = self._miss_cache.generation(entity_type)
+        
         results = self.find(entity_type, filters, fields, order, 
             filter_operator, 1, retired_only)
         
         if results:
             return results[0]
+        if miss_key:
+            self._miss_cache.set(miss_key, True, 
+                self.config.cache_misses_secs, tag=entity_type, 
+                generation=generation)
         return None
 
+    @_timeout_method
     def find(self, entity_type, filters, fields=None, order=None, 
-        filter_operator=None, limit=0, retired_only=False, page=0):
+        filter_operator=None, limit=0, retired_only=False, page=0,
+        max_parallel_pages=None, pagination="offset", cursor=None):
         """Find entities matching the given filters.
 
         :param entity_type: Required, entity type (string) to find.
@@ -368,15 +992,208 @@ class Shotgun(object):
         been retried. Defaults to False which returns only entities which 
         have not been retired. 
         
+        :param max_parallel_pages: Optional, number of pages to read from the 
+        server at the same time once the first page has been read. Each page 
+        is read on its own pooled connection. Defaults to 
+        config.max_parallel_pages. Not used with keyset pagination.
+        
+        :param pagination: Optional, how the pages of results are read. 
+        'offset' reads them by page number. 'keyset' orders the results by 
+        id and reads each page by asking for the entities with an id greater 
+        than the last id on the previous page, this keeps the cost of each 
+        page the same and does not skip or repeat entities if data changes 
+        while the pages are read. Defaults to 'offset'.
+        
+        :param cursor: Optional, for keyset pagination only return entities 
+        with an id greater than the cursor. Pass the id of the last entity 
+        read to resume reading. 
+        
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: list of the dicts for each entity with the requested fields,
         and their id and type. 
         """
         
+        if not isinstance(page, int) or page < 0:
+            raise ValueError("page parameter must be a positive integer")
+        
+        if page and pagination == "keyset":
+            raise ValueError("page parameter cannot be used with keyset "\
+                "pagination")
+
+        if max_parallel_pages is None:
+            max_parallel_pages = self.config.max_parallel_pages
+        if not isinstance(max_parallel_pages, int) or max_parallel_pages < 1:
+            raise ValueError("max_parallel_pages parameter must be a "\
+                "positive integer")
+
+        params = self._find_parameters(entity_type, filters, fields, order, 
+            filter_operator, limit, retired_only, pagination, page)
+
+        if limit and limit <= params["paging"]["entities_per_page"]:
+            # If page isn't set and the limit doesn't require pagination, 
+            # then trigger the faster code path.
+            if page == 0 and pagination != "keyset":
+                page = 1
+        
+        # if page is specified, then only return the page of records requested
+        if page != 0:
+            # No paging_info needed, so optimize it out.
+            params["return_paging_info"] = False 
+            params["paging"]["current_page"] = page
+            records = self._read_page(params).get("entities", [])
+            return self._parse_records(records)
+
+        records = []
+        for entities in self._read_pages(params, limit, max_parallel_pages,
+            pagination, cursor):
+            records.extend(entities)
+        
+        return self._parse_records(records)
+
+    @_timeout_method
+    def find_iter(self, entity_type, filters, fields=None, order=None, 
+        filter_operator=None, limit=0, retired_only=False, 
+        prefetch_pages=None, pagination="offset", cursor=None):
+        """Find entities matching the given filters, returning them one page 
+        at a time.
+        
+        Takes the same parameters as find(), but rather than returning a list
+        of all the entities returns an iterator. Each page of entities is read
+        from the server as the previous page is used up, so only one page is
+        held in memory at a time. 
+        
+        :param prefetch_pages: Optional, number of pages to read ahead on a 
+        background thread while the caller is using the current page. 0 
+        reads each page only when it is needed. Defaults to 
+        config.prefetch_pages.
+        
+        :param pagination: Optional, 'offset' or 'keyset', see find().
+        
+        :param cursor: Optional, id to resume keyset pagination after, see 
+        find().
+        
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
+        A timeout covers reading every page, including the time spent using 
+        the entities between pages.
+        
+        :returns: iterator of the dicts for each entity with the requested 
+        fields, and their id and type. 
+        """
+        
+        if prefetch_pages is None:
+            prefetch_pages = self.config.prefetch_pages
+        if not isinstance(prefetch_pages, int) or prefetch_pages < 0:
+            raise ValueError("prefetch_pages parameter must be a positive "\
+                "integer")
+            
+        params = self._find_parameters(entity_type, filters, fields, order, 
+            filter_operator, limit, retired_only, pagination)
+        pages = self._read_pages(params, limit, pagination=pagination, 
+            cursor=cursor)
+        # pages are read after this returns, maybe on the read ahead thread
+        pages = self._iter_with_deadline(pages)
+        if prefetch_pages:
+            pages = _ReadAhead(self, pages, prefetch_pages)
+        return self._iter_records(pages)
+
+    @_timeout_method
+    def find_many(self, queries, max_workers=None):
+        """Runs several find() queries at the same time. 
+        
+        :param queries: Required, list of the queries to run. Each query is 
+        either a dict of keyword arguments for find(), e.g. 
+        {'entity_type':'Shot', 'filters':[], 'fields':['code']}, or a 
+        list or tuple of positional arguments for find().
+        
+        :param max_workers: Optional, maximum number of queries to run at 
+        once, each uses its own pooled connection. Defaults to 
+        config.max_concurrent_queries.
+        
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
+        :returns: list with the result of find() for each query, in the same 
+        order as queries. If a query raised an exception the exception is 
+        returned in its place, the other queries are not affected. 
+        """
+        
+        if not isinstance(queries, (list, tuple)):
+            raise ShotgunError("find_many() expects a list. Instead was "\
+                "sent a %s" % type(queries))
+        if max_workers is None:
+            max_workers = self.config.max_concurrent_queries
+        if not isinstance(max_workers, int) or max_workers < 1:
+            raise ValueError("max_workers parameter must be a positive "\
+                "integer")
+        
+        def _find(query):
+            if isinstance(query, dict):
+                return self.find(**query)
+            return self.find(*query)
+        
+        return [
+            (exc_info and exc_info[1]) or result
+            for result, exc_info in self._run_concurrent(_find, list(queries),
+                max_workers)
+        ]
+
+    def _iter_with_deadline(self, iterable):
+        """Returns an iterator that reads each item of iterable with the 
+        deadline of the call being made on this thread.
+        """
+        next_item = self._bind_deadline(iter(iterable).next)
+        def _iter():
+            while True:
+                try:
+                    item = next_item()
+                except StopIteration:
+                    return
+                yield item
+        return _iter()
+
+    def _iter_records(self, pages):
+        """Generator that parses each page of records as it is needed.
+        
+        :param pages: iterable of lists of raw records. 
+        """
+        for entities in pages:
+            for record in self._parse_records(entities):
+                yield record
+    
+    def _find_parameters(self, entity_type, filters, fields, order, 
+        filter_operator, limit, retired_only, pagination="offset", page=0):
+        """Validates the arguments for find() and builds the parameters for 
+        the read rpc method.
+        
+        The page size is only tuned by config.adaptive_paging when page is 0,
+        a page asked for by number is always config.records_per_page long.
+        """
+        
         if not isinstance(limit, int) or limit < 0:
             raise ValueError("limit parameter must be a positive integer")
 
-        if not isinstance(page, int) or page < 0:
-            raise ValueError("page parameter must be a positive integer")
+        if pagination not in ("offset", "keyset"):
+            raise ValueError("pagination parameter must be 'offset' or "\
+                "'keyset', got '%s'" % (pagination,))
+        if pagination == "keyset" and order:
+            raise ValueError("order parameter cannot be used with keyset "\
+                "pagination, entities are ordered by id")
 
         if isinstance(filters, (list, tuple)):
             filters = _translate_filters(filters, filter_operator)
@@ -391,38 +1208,148 @@ class Shotgun(object):
                                                  retired_only,
                                                  order)
 
-        if limit and limit <= self.config.records_per_page:
+        if self.config.adaptive_paging and page == 0:
+            params["paging"]["entities_per_page"] = \
+                self._page_sizer.page_size(params)
+        if limit and limit <= params["paging"]["entities_per_page"]:
             params["paging"]["entities_per_page"] = limit
-            # If page isn't set and the limit doesn't require pagination, 
-            # then trigger the faster code path.
-            if page == 0:
-                page = 1
         
-        # if page is specified, then only return the page of records requested
-        if page != 0:
-            # No paging_info needed, so optimize it out.
-            params["return_paging_info"] = False 
-            params["paging"]["current_page"] = page
-            records = self._call_rpc("read", params).get("entities", [])
-            return self._parse_records(records)
+        if pagination == "keyset":
+            params["sorts"] = [{"field_name" : "id", "direction" : "asc"}]
+            # keyset pages do not need the total count
+            params["return_paging_info"] = False
+        return params
 
-        records = []
-        result = self._call_rpc("read", params)
+    def _read_pages(self, params, limit=0, max_parallel_pages=1, 
+        pagination="offset", cursor=None):
+        """Generator that reads the pages of entities for the read parameters.
+        
+        :param limit: Maximum number of entities to return, 0 returns all 
+        entities. No more pages are read once the limit is reached. 
+        
+        :param max_parallel_pages: Number of pages to read at once after the 
+        first page. 
+        
+        :param pagination: 'offset' or 'keyset', see find().
+        
+        :param cursor: id to start keyset pagination after.
+        
+        :yields: list of the raw entities on each page.
+        """
+        if pagination == "keyset":
+            pages = self._read_pages_keyset(params, cursor)
+        else:
+            result = self._read_page(params)
+            if max_parallel_pages > 1 and result.get("entities"):
+                pages = [result["entities"]]
+                pages.extend(self._read_pages_parallel(params, result, limit, 
+                    max_parallel_pages))
+            else:
+                pages = self._read_pages_serial(params, result)
+        
+        count = 0
+        for entities in pages:
+            if limit and count + len(entities) >= limit:
+                yield entities[:limit - count]
+                return
+            count += len(entities)
+            yield entities
+
+    def _read_pages_serial(self, params, result):
+        """Generator that reads the pages after the first page one by one.
+        
+        :param result: Result of reading the first page.
+        
+        :yields: list of the raw entities on each page.
+        """
+        count = 0
         while result.get("entities"):
-            records.extend(result.get("entities"))
+            yield result["entities"]
             
-            if limit and len(records) >= limit:
-                records = records[:limit]
-                break
-            if len(records) == result["paging_info"]["entity_count"]:
-                break
+            count += len(result["entities"])
+            if count == result["paging_info"]["entity_count"]:
+                return
             
             params['paging']['current_page'] += 1
-            result = self._call_rpc("read", params)
+            result = self._read_page(params)
+
+    def _read_page(self, params):
+        """Calls the read rpc method for one page of entities. 
         
-        return self._parse_records(records)
+        When config.adaptive_paging is set the time taken and size of the 
+        response are used to tune the page size for later reads. 
+        
+        :returns: The read result.
+        """
+        start = time.time()
+        result = self._call_rpc("read", params)
+        if self.config.adaptive_paging and \
+            not getattr(self._thread_state, "cache_hit", False):
+            self._page_sizer.record(params, len(result.get("entities") or []),
+                time.time() - start, 
+                getattr(self._thread_state, "response_size", 0))
+        return result
 
+    def _read_pages_keyset(self, params, cursor=None):
+        """Generator that reads pages ordered by id, each page is the first 
+        page of the entities with an id greater than the last id read.
+        
+        :param cursor: Optional, id to start reading after. 
+        
+        :yields: list of the raw entities on each page.
+        """
+        while True:
+            page_params = params
+            if cursor is not None:
+                page_params = dict(params)
+                page_params["filters"] = _add_filter_condition(
+                    params["filters"], ["id", "greater_than", cursor])
+            
+            entities = self._read_page(page_params).get("entities")
+            if not entities:
+                return
+            yield entities
+            
+            if len(entities) < params["paging"]["entities_per_page"]:
+                return
+            cursor = entities[-1]["id"]
+            
+            # keyset pages can change size as they are tuned
+            if self.config.adaptive_paging:
+                params = dict(params)
+                params["paging"] = dict(params["paging"], 
+                    entities_per_page=self._page_sizer.page_size(params))
 
+    def _read_pages_parallel(self, params, first_result, limit, max_workers):
+        """Reads the pages of a find() after the first page concurrently.
+        
+        The paging_info returned with the first page is used to work out which
+        pages remain, they are read by up to max_workers threads and returned 
+        in page order.
+        
+        :returns: list of the raw entities on each page after the first. 
+        """
+        entities_per_page = params["paging"]["entities_per_page"]
+        entity_count = first_result["paging_info"]["entity_count"]
+        if limit:
+            entity_count = min(entity_count, limit)
+        last_page = (entity_count + entities_per_page - 1) // entities_per_page
+        
+        def _read_page(page_num):
+            page_params = dict(params)
+            page_params["paging"] = dict(params["paging"], 
+                current_page=page_num)
+            page_params["return_paging_info"] = False
+            return self._read_page(page_params).get("entities", [])
+        
+        pages = []
+        results = self._run_concurrent(_read_page, range(2, last_page + 1),
+            max_workers, stop_on_error=True)
+        for entities, exc_info in results:
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            pages.append(entities)
+        return pages
 
     def _construct_read_parameters(self,
                                    entity_type,
@@ -453,6 +1380,7 @@ class Shotgun(object):
             params['sorts'] = sort_list
         return params
            
+    @_timeout_method
     def summarize(self,
                   entity_type,
                   filters,
@@ -462,6 +1390,13 @@ class Shotgun(object):
         """
         Return group and summary information for entity_type for summary_fields
         based on the given filters.
+        
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
         """
         if not isinstance(filters, list):
             raise ValueError("summarize() 'filters' parameter must be a list")
@@ -480,6 +1415,7 @@ class Shotgun(object):
         records = self._call_rpc('summarize', params)
         return records
 
+    @_timeout_method
     def create(self, entity_type, data, return_fields=None):
         """Create a new entity of the specified entity_type.
         
@@ -490,6 +1426,13 @@ class Shotgun(object):
         :param return_fields: Optional list of fields from the new entity 
         to return. Defaults to 'id' field.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: dict of the requested fields.
         """
         
@@ -500,8 +1443,10 @@ class Shotgun(object):
         }
         
         record = self._call_rpc("create", params, first=True)
+        self.invalidate_cache(entity_type)
         return self._parse_records(record)[0]
         
+    @_timeout_method
     def update(self, entity_type, entity_id, data):
         """Updates the specified entity with the supplied data.
         
@@ -511,6 +1456,13 @@ class Shotgun(object):
         
         :param data: Required, dict fields to update on the entity. 
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: dict of the fields updated, with the entity_type and 
         id added.
         """
@@ -522,8 +1474,12 @@ class Shotgun(object):
         }
         
         record = self._call_rpc("update", params)
+        self.invalidate_cache(entity_type)
+        if "image" in data:
+            self._thumb_urls.invalidate((entity_type, entity_id))
         return self._parse_records(record)[0]
 
+    @_timeout_method
     def delete(self, entity_type, entity_id):
         """Retire the specified entity. 
         
@@ -533,6 +1489,13 @@ class Shotgun(object):
 
         :param entity_id: Required, id of the entity to delete.
 
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: True if the entity was deleted, False otherwise e.g. if the 
         entity has previously been deleted.
         """
@@ -542,8 +1505,11 @@ class Shotgun(object):
             "id" : entity_id
         }
 
-        return self._call_rpc("delete", params)
+        result = self._call_rpc("delete", params)
+        self.invalidate_cache(entity_type)
+        return result
 
+    @_timeout_method
     def revive(self, entity_type, entity_id):
         """Revive an entity that has previously been deleted. 
         
@@ -551,6 +1517,13 @@ class Shotgun(object):
 
         :param entity_id: Required, id of the entity to revive.
 
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: True if the entity was revived, False otherwise e.g. if the 
         entity has previously been revived (or was not deleted).
         """
@@ -560,8 +1533,11 @@ class Shotgun(object):
             "id" : entity_id
         }
 
-        return self._call_rpc("revive", params)
+        result = self._call_rpc("revive", params)
+        self.invalidate_cache(entity_type)
+        return result
 
+    @_timeout_method
     def batch(self, requests):
         """Make a batch request  of several create, update and delete calls. 
 
@@ -574,6 +1550,13 @@ class Shotgun(object):
             - update: entity_type, entity_id, data dict of fields to set
             - delete: entity_type and entity_id
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: A list of values for each operation, create and update 
         requests return a dict of the fields updated. Delete requests 
         return True if the entity was deleted.  
@@ -615,25 +1598,51 @@ class Shotgun(object):
                 raise ShotgunError("Invalid request_type '%s' for batch" % (
                                    req["request_type"]))
             calls.append(request_params)
-        records = self._call_rpc("batch", calls)
+        try:
+            records = self._call_rpc("batch", calls)
+        finally:
+            # the transaction may have been applied even if the call failed
+            for entity_type in set(req["entity_type"] for req in requests):
+                self.invalidate_cache(entity_type)
+            for req in requests:
+                if req["request_type"] == "update" and "image" in req["data"]:
+                    self._thumb_urls.invalidate((req["entity_type"], 
+                        req["entity_id"]))
         return self._parse_records(records)
         
+    @_timeout_method
     def schema_entity_read(self):
         """Gets all active entities defined in the schema. 
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: dict of Entity Type to dict containing the display name. 
         """
         
-        return self._call_rpc("schema_entity_read", None)
+        return self._read_schema("schema_entity_read", None)
                 
+    @_timeout_method
     def schema_read(self):
         """Gets the schema for all fields in all entities.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: nested dicts
         """
         
-        return self._call_rpc("schema_read", None)
+        return self._read_schema("schema_read", None)
 
+    @_timeout_method
     def schema_field_read(self, entity_type, field_name=None):
         """Gets all schema for fields in the specified entity_type or one 
         field.
@@ -645,6 +1654,13 @@ class Shotgun(object):
         definition for. If not supplied all fields for the entity type are 
         returned.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: dict of field name to nested dicts which describe the field 
         """
         
@@ -654,8 +1670,9 @@ class Shotgun(object):
         if field_name:
             params["field_name"] = field_name
             
-        return self._call_rpc("schema_field_read", params)
+        return self._read_schema("schema_field_read", params)
 
+    @_timeout_method
     def schema_field_create(self, entity_type, data_type, display_name, 
         properties=None):
         """Creates a field for the specified entity type. 
@@ -668,6 +1685,13 @@ class Shotgun(object):
         
         :param properties: Optional, dict of properties for the new field. 
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: The Shotgun name (string) for the new field, this is 
         different to the display_name passed in.
         """
@@ -682,8 +1706,11 @@ class Shotgun(object):
         params["properties"].extend(self._dict_to_list(properties, 
             key_name="property_name", value_name="value"))
         
-        return self._call_rpc("schema_field_create", params)
+        result = self._call_rpc("schema_field_create", params)
+        self.invalidate_schema_cache()
+        return result
         
+    @_timeout_method
     def schema_field_update(self, entity_type, field_name, properties):
         """Updates the specified field definition with the supplied 
         properties.
@@ -694,6 +1721,13 @@ class Shotgun(object):
         
         :param properties: Required, dict of updated properties for the field.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: True if the field was updated, False otherwise.
         """
 
@@ -706,8 +1740,11 @@ class Shotgun(object):
             ]
         }
         
-        return self._call_rpc("schema_field_update", params)
+        result = self._call_rpc("schema_field_update", params)
+        self.invalidate_schema_cache()
+        return result
         
+    @_timeout_method
     def schema_field_delete(self, entity_type, field_name):
         """Deletes the specified field definition from the entity_type.
 
@@ -718,6 +1755,13 @@ class Shotgun(object):
         
         :param properties: Required, dict of updated properties for the field.
         
+        :param timeout: Optional, seconds the call must finish in, including 
+        any retries, or CallTimeoutError is raised. Defaults to no limit 
+        other than config.timeout_secs for each request. 
+        
+        :param deadline: Optional, time.time() value the call must finish 
+        by, as for timeout. The earlier of the two is used if both are given.
+        
         :returns: True if the field was updated, False otherwise.
         """
         
@@ -726,7 +1770,49 @@ class Shotgun(object):
             "field_name" : field_name
         }
         
-        return self._call_rpc("schema_field_delete", params)
+        result = self._call_rpc("schema_field_delete", params)
+        self.invalidate_schema_cache()
+        return result
+
+    def invalidate_cache(self, entity_type=None):
+        """Removes cached results from the client's result cache, see 
+        config.cache_results, and the cached find_one() misses, see 
+        config.cache_misses_secs. 
+        
+        The cache is invalidated automatically when this client creates, 
+        updates, deletes or revives entities. Call this when entities are 
+        changed by other clients.
+        
+        :param entity_type: Optional, entity type (string) to remove the 
+        results for. Defaults to removing all results. 
+        """
+        if entity_type is None:
+            self._result_cache.invalidate()
+            self._miss_cache.invalidate()
+        else:
+            self._result_cache.invalidate_tag(entity_type)
+            self._miss_cache.invalidate_tag(entity_type)
+        return
+
+    def invalidate_schema_cache(self):
+        """Removes the cached schema for the server, see config.cache_schema.
+        
+        The next schema read is made to the server. The schema cache is 
+        invalidated automatically when this client changes a field. 
+        """
+        self._schema_cache.invalidate()
+        cache_dir = self.config.cache_dir
+        if not cache_dir or not os.path.isdir(cache_dir):
+            return
+        
+        prefix = self._schema_cache_prefix()
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(cache_dir, file_name))
+                except OSError:
+                    pass
+        return
 
     def set_session_uuid(self, session_uuid):
         """Sets the browser session_uuid for this API session. 
@@ -826,6 +1912,8 @@ class Shotgun(object):
         attachment_id = 0
         if len(r) > 1:
             attachment_id = int(str(result).split(":")[1].split("\n")[0])
+        if is_thumbnail:
+            self._thumb_urls.invalidate((entity_type, entity_id))
         return attachment_id
     
     def download_attachment(self, attachment_id):
@@ -874,9 +1962,102 @@ class Shotgun(object):
                 raise ShotgunError(error_string)
         return attachment
 
-    def _get_session_token(self):
-        """Hack to authenticate in order to download protected content
-        like Attachments
+    def _read_schema(self, method, params):
+        """Calls a schema read rpc method. 
+        
+        When config.cache_schema is set results are cached in memory, and on
+        disk in config.cache_dir, for config.schema_cache_secs. The 
+        cache is keyed by the server host and version so it is not used 
+        after the server is upgraded.
+        
+        :returns: The result of the call, it is not shared with the cache.
+        """
+        if not self.config.cache_schema:
+            return self._call_rpc(method, params)
+        
+        wire = json.dumps([method, params], sort_keys=True)
+        if isinstance(wire, unicode):
+            wire = wire.encode("utf-8")
+        key = self._schema_cache_prefix() + sha1(wire).hexdigest()
+        
+        result = self._schema_cache.get(key)
+        if result is None:
+            result = self._read_cache_file(key + ".json", 
+                self.config.schema_cache_secs)
+            if result is None:
+                result = self._call_rpc(method, params)
+                self._write_cache_file(key + ".json", result)
+            self._schema_cache.set(key, result, self.config.schema_cache_secs)
+        return copy.deepcopy(result)
+
+    def _schema_cache_prefix(self):
+        """Returns the prefix of the schema cache keys for the server."""
+        caps = self.server_caps
+        version = ".".join(str(v) for v in caps.version)
+        if caps.is_dev:
+            version += "dev"
+        return "%s_%s_" % (re.sub(r"[^\w.-]", "_", caps.host), version)
+
+    def _server_info_file_name(self):
+        """Returns the name of the file the server info is cached in."""
+        return "%s_server_info.json" % (
+            re.sub(r"[^\w.-]", "_", self.config.server),)
+
+    def _discard_cached_server_caps(self, remove_file=True):
+        """Forgets server capabilities that were read from the cache, so 
+        they are read from the server when next needed. 
+        
+        :param remove_file: Optional, also remove the server info cached in 
+        config.cache_dir, which is shared with other clients. 
+        """
+        if not self._server_caps_cached:
+            return
+        LOG.debug("Discarding cached server info for %s" % (
+            self.config.server,))
+        self._server_caps = None
+        self._server_caps_cached = False
+        if remove_file and self.config.cache_dir:
+            try:
+                os.remove(os.path.join(self.config.cache_dir, 
+                    self._server_info_file_name()))
+            except OSError:
+                pass
+
+    def _read_cache_file(self, file_name, max_age):
+        """Returns the data cached in config.cache_dir in the file, or None 
+        if it is not cached or is more than max_age seconds old."""
+        cache_dir = self.config.cache_dir
+        if not cache_dir:
+            return None
+        
+        path = os.path.join(cache_dir, file_name)
+        try:
+            if os.path.getmtime(path) + max_age < time.time():
+                return None
+            f = open(path, "rb")
+            try:
+                return self._json_loads(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cache_file(self, file_name, data):
+        """Caches the data in config.cache_dir in the file. Errors writing 
+        the file are logged and ignored."""
+        cache_dir = self.config.cache_dir
+        if not cache_dir:
+            return
+        
+        path = os.path.join(cache_dir, file_name)
+        try:
+            _write_file_atomic(path, self._encode_payload(data))
+        except (IOError, OSError), e:
+            LOG.warning("Could not write cache file %s: %s" % (path, e))
+
+    def _get_session_token(self):
+        """Hack to authenticate in order to download protected content
+        like Attachments
         """
         if self.config.session_token:
             return self.config.session_token
@@ -909,21 +2090,23 @@ class Shotgun(object):
             method, params))
             
         params = self._transform_outbound(params)
-        payload = self._build_payload(method, params, 
-            include_script_name=include_script_name)
-        encoded_payload = self._encode_payload(payload)
-        
-        req_headers = {
-            "content-type" : "application/json; charset=utf-8",
-            "connection" : "keep-alive"
-        }
-        http_status, resp_headers, body = self._make_call("POST", 
-            self.config.api_path, encoded_payload, req_headers)
-        LOG.info("Completed rpc call to %s" % (method))
-                
-        self._parse_http_status(http_status)
-        response = self._decode_response(resp_headers, body)
-        self._response_errors(response)
+        cache_key = self._cache_key(method, params)
+        cached = cache_key and self._result_cache.get_entry(cache_key)
+        self._thread_state.cache_hit = bool(cached)
+        
+        if cached:
+            (resp_headers, body), stale = cached
+            if stale:
+                LOG.debug("Using stale cached result for rpc call to %s" % (
+                    method))
+                self._revalidate(method, params, include_script_name, 
+                    cache_key)
+            else:
+                LOG.debug("Using cached result for rpc call to %s" % (method))
+            response = self._decode_response(resp_headers, body)
+        else:
+            response = self._send_rpc(method, params, include_script_name, 
+                cache_key)
         response = self._transform_inbound(response)
         
         if not isinstance(response, dict) or "results" not in response:
@@ -934,6 +2117,246 @@ class Shotgun(object):
             return results[0] 
         return results
 
+    def _send_rpc(self, method, params, include_script_name, cache_key):
+        """Sends the rpc call to the server and caches the response if 
+        cache_key is set.
+        
+        :returns: The decoded response.
+        """
+        payload = self._build_payload(method, params, 
+            include_script_name=include_script_name)
+        encoded_payload = self._encode_payload(payload)
+        generation = None
+        if method in _READ_METHODS and isinstance(params, dict):
+            # a result read before the cache is invalidated is not cached, or
+            # shared with calls made after
+            entity_type = params.get("type")
+            generation = self._result_cache.generation(entity_type)
+        http_status, resp_headers, body = self._post_rpc(method, 
+            encoded_payload, generation)
+        LOG.info("Completed rpc call to %s" % (method))
+        self._thread_state.response_size = len(body or "")
+        
+        try:
+            self._parse_http_status(http_status)
+        except ProtocolError, e:
+            # the cached server info may be out of date, a status that may 
+            # pass does not show it is so the file is kept for other clients
+            self._discard_cached_server_caps(
+                e.errcode not in RetryPolicy.RETRY_STATUSES)
+            raise
+        response = self._decode_response(resp_headers, body)
+        self._response_errors(response)
+        if cache_key:
+            self._result_cache.set(cache_key, (resp_headers, body), 
+                self.config.cache_ttls.get(entity_type, 
+                    self.config.cache_ttl_secs), 
+                len(body or ""), entity_type, 
+                self.config.cache_stale_ttls.get(entity_type, 
+                    self.config.cache_stale_secs), generation)
+        return response
+
+    def _revalidate(self, method, params, include_script_name, cache_key):
+        """Reads a stale cached result again on a background thread, unless 
+        it is already being read."""
+        self._in_flight_lock.acquire()
+        try:
+            if cache_key in self._revalidating:
+                return
+            self._revalidating.add(cache_key)
+        finally:
+            self._in_flight_lock.release()
+        
+        def _refresh():
+            try:
+                try:
+                    self._send_rpc(method, params, include_script_name, 
+                        cache_key)
+                except Exception:
+                    LOG.exception("Error refreshing the cached result for "\
+                        "rpc call to %s" % (method))
+            finally:
+                self._in_flight_lock.acquire()
+                try:
+                    self._revalidating.discard(cache_key)
+                finally:
+                    self._in_flight_lock.release()
+        self._start_worker(_refresh)
+
+    def _post_rpc(self, method, encoded_payload, generation=None):
+        """Posts the encoded payload for an rpc call to the server. 
+        
+        If config.coalesce_reads is set and an identical read call is in 
+        flight on another thread, waits for its response rather than 
+        sending another request. If that call fails and its timeout was 
+        shorter than this one's, sends the request again, as the failure may 
+        be down to the other call's timeout. 
+        
+        :param generation: Optional, result cache generation() of the entity 
+        type read. A call is not shared once the cache has been invalidated, 
+        its response may be from before a change this call must see. 
+        
+        :returns: Tuple of (http status, response headers, response body).
+        """
+        req_headers = {
+            "content-type" : "application/json; charset=utf-8",
+            "connection" : "keep-alive"
+        }
+        if not self.config.coalesce_reads or method not in _READ_METHODS:
+            return self._send_request(method, encoded_payload, req_headers)
+        
+        deadline = getattr(self._thread_state, "deadline", None)
+        self._in_flight_lock.acquire()
+        try:
+            in_flight = self._in_flight.get(encoded_payload)
+            leader = in_flight is None or in_flight[2] != generation
+            if leader:
+                # replaces a call sent before the cache was invalidated
+                future = _Future()
+                self._in_flight[encoded_payload] = (future, deadline, 
+                    generation)
+            else:
+                future, leader_deadline, _ = in_flight
+        finally:
+            self._in_flight_lock.release()
+        if not leader:
+            LOG.debug("Waiting for identical rpc call to %s" % (method))
+            try:
+                return future.result(self._time_left())
+            except Exception:
+                if not future.done() or leader_deadline is None or \
+                    (deadline is not None and deadline <= leader_deadline):
+                    raise
+            LOG.debug("Identical rpc call to %s failed within its timeout, "\
+                "sending it again" % (method))
+            return self._send_request(method, encoded_payload, req_headers)
+        
+        result = exc_info = None
+        try:
+            try:
+                result = self._send_request(method, encoded_payload, 
+                    req_headers)
+            except:
+                exc_info = sys.exc_info()
+                raise
+        finally:
+            self._in_flight_lock.acquire()
+            try:
+                in_flight = self._in_flight.get(encoded_payload)
+                if in_flight is not None and in_flight[0] is future:
+                    del self._in_flight[encoded_payload]
+            finally:
+                self._in_flight_lock.release()
+            future._set_result(result, exc_info)
+        return result
+
+    def _send_request(self, method, encoded_payload, req_headers):
+        """Makes the request for an rpc call, hedging it if 
+        config.hedge_reads is set. 
+        
+        :returns: Tuple of (http status, response headers, response body).
+        """
+        if method not in _HEDGE_METHODS:
+            return self._make_call("POST", self.config.api_path, 
+                encoded_payload, req_headers, method)
+        
+        delay = None
+        if self.config.hedge_reads:
+            delay = self._latencies.percentile(method, 
+                self.config.hedge_percentile)
+        if delay is None:
+            start = time.time()
+            result = self._make_call("POST", self.config.api_path, 
+                encoded_payload, req_headers, method)
+            if result[0][0] < 300:
+                self._latencies.record(method, time.time() - start)
+            return result
+        return self._hedged_request(method, delay, encoded_payload, 
+            req_headers)
+
+    def _hedged_request(self, method, delay, encoded_payload, req_headers):
+        """Makes the request for a read on a worker thread, and if it has not
+        returned after delay secs makes it again on its own thread and 
+        connection. 
+        
+        The first good response is used, an error is only raised once both 
+        requests have failed. The other request is cancelled by closing its 
+        connection. 
+        """
+        responses = Queue.Queue()
+        cancel = _Cancel(self._connection_pool)
+        deadline = getattr(self._thread_state, "deadline", None)
+        
+        def _request(hedge):
+            state = self._thread_state
+            state.deadline = deadline
+            state.cancel = cancel
+            start = time.time()
+            try:
+                try:
+                    result = self._make_call("POST", self.config.api_path, 
+                        encoded_payload, req_headers, method, hedge=hedge)
+                except:
+                    responses.put((None, sys.exc_info()))
+                    return
+            finally:
+                state.deadline = state.cancel = None
+            if result[0][0] < 300:
+                self._latencies.record(method, time.time() - start)
+            responses.put((result, None))
+        
+        def _good(response):
+            return response[1] is None and response[0][0][0] < 300
+        
+        responses_due = 1
+        received = []
+        self._hedge_workers.submit(_request, False)
+        try:
+            received.append(responses.get(True, delay))
+        except Queue.Empty:
+            LOG.debug("No response to rpc call to %s after %.3f secs, "\
+                "sending it again" % (method, delay))
+            # not queued behind the workers, they may all be stragglers
+            self._start_worker(lambda: _request(True))
+            responses_due = 2
+        try:
+            while len(received) < responses_due and \
+                not (received and _good(received[-1])):
+                time_left = self._time_left()
+                if time_left is not None:
+                    time_left = max(time_left, 0)
+                try:
+                    received.append(responses.get(True, time_left))
+                except Queue.Empty:
+                    raise CallTimeoutError("Call did not finish within its "\
+                        "timeout")
+        finally:
+            cancel.set()
+        
+        result, exc_info = ([r for r in received if _good(r)] or received)[0]
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result
+
+    def _cache_key(self, method, params):
+        """Returns the key to cache the result of the rpc call with, or None 
+        if the result should not be cached. 
+        
+        :param params: Outbound params for the call, the key is a hash of 
+        their canonical json encoding. 
+        """
+        if not self.config.cache_results or method not in ("read", 
+            "summarize"):
+            return None
+        # the event log is read to find changes, it must always be current
+        if params.get("type") == "EventLogEntry":
+            return None
+        
+        wire = json.dumps([method, params], sort_keys=True)
+        if isinstance(wire, unicode):
+            wire = wire.encode("utf-8")
+        return sha1(wire).hexdigest()
+
     def _build_payload(self, method, params, include_script_name=True):
         """Builds the payload to be send to the rpc endpoint.
         
@@ -976,8 +2399,18 @@ class Shotgun(object):
             return wire.encode("utf-8")
         return wire
 
-    def _make_call(self, verb, path, body, headers):
+    def _make_call(self, verb, path, body, headers, method=None, 
+        hedge=False):
         """Makes a HTTP call to the server, handles retry and failure.
+        
+        Failed requests are repeated up to config.max_rpc_attempts times as
+        config.retry_policy allows. If the call has a timeout the requests, 
+        including the waits before each one, must finish within it. 
+        
+        :param method: Optional, rpc method the call is for. 
+        
+        :param hedge: Optional, if True the call repeats a request that is 
+        still in flight, and does not add to the retry budget. 
         """
         
         attempt = 0
@@ -991,16 +2424,84 @@ class Shotgun(object):
         body = body or None
         
         max_rpc_attempts = self.config.max_rpc_attempts
+        policy = self.config.retry_policy
+        if not hedge:
+            policy.record_request()
+        breaker = self.config.circuit_breaker
+        limiter = self.config.rate_limiter
         
-        while (attempt < max_rpc_attempts):            
+        while True:
             attempt +=1
+            result = exc_info = None
+            cancel = getattr(self._thread_state, "cancel", None)
+            if cancel is not None and cancel.isSet():
+                raise CallTimeoutError("Call is no longer needed, another "\
+                    "request answered it")
+            time_left = self._time_left()
+            if time_left is not None and time_left <= 0:
+                raise CallTimeoutError("Call did not finish within its "\
+                    "timeout")
+            probe = breaker and breaker.before_request()
+            if limiter and not limiter.acquire(time_left):
+                if probe:
+                    breaker.record_skipped()
+                raise CallTimeoutError("Call did not start within its "\
+                    "timeout, the rate limit was reached")
+            start = time.time()
             try:
-                return self._http_request(verb, path, body, req_headers)
-            except Exception:
-                #TODO: LOG ?
-                self._close_connection()
-                if attempt == max_rpc_attempts:
-                    raise
+                try:
+                    result = self._http_request(verb, path, body, req_headers)
+                except Exception:
+                    exc_info = sys.exc_info()
+            finally:
+                # the slot is freed even if the request was interrupted
+                if limiter:
+                    limiter.release(time.time() - start, 
+                        status=result and result[0][0], 
+                        error=exc_info and exc_info[1])
+                if probe and not (result or exc_info):
+                    breaker.record_skipped()
+            if exc_info:
+                e = exc_info[1]
+                # a request that was cut off was not failed by the server
+                cancelled = cancel is not None and cancel.isSet()
+                if breaker:
+                    # only a response shows the server is working
+                    if _transport_error(e) and not cancelled:
+                        breaker.record_failure()
+                    elif probe:
+                        breaker.record_skipped()
+                if cancelled:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if attempt >= max_rpc_attempts or \
+                    not policy.is_retryable(verb, method, error=e) or \
+                    not policy.spend_retry():
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                LOG.debug("Request failed with %r" % (e,))
+            else:
+                status = result[0][0]
+                if breaker:
+                    if status in RetryPolicy.RETRY_STATUSES:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if attempt >= max_rpc_attempts or \
+                    not policy.is_retryable(verb, method, status=status) or \
+                    not policy.spend_retry():
+                    return result
+                LOG.debug("Request failed with status %s" % (status,))
+            
+            delay = policy.backoff(attempt)
+            time_left = self._time_left()
+            if time_left is not None and delay >= time_left:
+                LOG.debug("Not repeating request, there is not time before "\
+                    "the call's timeout")
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return result
+            LOG.debug("Repeating request in %.2f secs, attempt %d of %d" % (
+                delay, attempt + 1, max_rpc_attempts))
+            time.sleep(delay)
     
     def _http_request(self, verb, path, body, headers):
         """Makes the actual HTTP request.
@@ -1012,8 +2513,21 @@ class Shotgun(object):
         LOG.debug("Request body is %s" % body)
         
         conn = self._get_connection()
-        resp, content = conn.request(url,method=verb, body=body, 
-            headers=headers)
+        timeout = self._time_left()
+        if timeout is not None:
+            if self.config.timeout_secs is not None:
+                timeout = min(timeout, self.config.timeout_secs)
+            _set_timeout(conn, max(timeout, 0.001))
+        try:
+            resp, content = conn.request(url,method=verb, body=body, 
+                headers=headers)
+        except Exception:
+            # only this connection is suspect, others stay open
+            self._release_connection(conn, discard=True)
+            raise
+        if timeout is not None:
+            _set_timeout(conn, self.config.timeout_secs)
+        self._release_connection(conn)
         #http response code is handled else where
         http_status = (resp.status, resp.reason)
         resp_headers = dict(
@@ -1204,35 +2718,149 @@ class Shotgun(object):
     # Connection Functions
     
     def _get_connection(self):
-        """Returns the current connection or creates a new connection to the 
-        current server. 
+        """Checks out a connection to the current server from the pool. 
+        
+        The connection must be returned with _release_connection() once the
+        request is complete. 
+        """
+        conn = self._connection_pool.checkout(self._time_left())
+        cancel = getattr(self._thread_state, "cancel", None)
+        if cancel is not None and not cancel.watch(conn):
+            self._connection_pool.checkin(conn)
+            raise CallTimeoutError("Call is no longer needed, another "\
+                "request answered it")
+        return conn
+
+    def _time_left(self):
+        """Returns the seconds left before the timeout of the call being made
+        on this thread, or None if it does not have a timeout."""
+        deadline = getattr(self._thread_state, "deadline", None)
+        if deadline is None:
+            return None
+        return deadline - time.time()
+
+    def _release_connection(self, conn, discard=False):
+        """Returns a connection to the pool.
+        
+        :param discard: If True the connection is closed rather than reused, 
+        e.g. after a network error.
         """
-        if self._connection is not None:
-            return self._connection
+        cancel = getattr(self._thread_state, "cancel", None)
+        if cancel is not None and not cancel.unwatch(conn):
+            # the pool let go of it when another request answered the call
+            _close_http(conn)
+        elif discard:
+            self._connection_pool.discard(conn)
+        else:
+            self._connection_pool.checkin(conn)
+
+    def _new_connection(self):
+        """Creates a new connection to the current server."""
         
         if self.config.proxy_server:
             pi = ProxyInfo(PROXY_TYPE_HTTP, self.config.proxy_server, 
                 self.config.proxy_port)
-            self._connection = Http(timeout=self.config.timeout_secs, 
-                proxy_info=pi)
-        else:
-            self._connection = Http(timeout=self.config.timeout_secs)
-        
-        return self._connection
+            return Http(timeout=self.config.timeout_secs, proxy_info=pi)
+        return Http(timeout=self.config.timeout_secs)
 
     def _close_connection(self):
-        """Closes the current connection."""
-        if self._connection is None:
-            return
+        """Closes the idle connections in the pool."""
+        self._connection_pool.close()
+        return
+
+    def _start_worker(self, func):
+        """Starts a daemon thread that calls func. 
         
-        for conn in self._connection.connections.values():
+        :returns: The started Thread.
+        """
+        t = threading.Thread(target=func)
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def _bind_deadline(self, func):
+        """Returns func wrapped to run with the deadline of the call being 
+        made on this thread, so the calls it makes on a worker thread share 
+        the timeout."""
+        deadline = getattr(self._thread_state, "deadline", None)
+        if deadline is None:
+            return func
+        
+        def _call(*args, **kwargs):
+            state = self._thread_state
+            outer = getattr(state, "deadline", None)
+            state.deadline = deadline
             try:
-                conn.close()
-            except Exception:
-                pass
-        self._connection.connections.clear()
-        self._connection = None
-        return
+                return func(*args, **kwargs)
+            finally:
+                state.deadline = outer
+        return _call
+
+    def _run_concurrent(self, func, items, max_workers, stop_on_error=False):
+        """Calls func once for each of the items using up to max_workers 
+        threads, calls to the server use connections from the pool. 
+        
+        :param func: Callable that accepts a single item. 
+        
+        :param items: List of the items to call func with. 
+        
+        :param max_workers: Maximum number of threads to start.
+        
+        :param stop_on_error: If True no more items are started once a call 
+        has raised an exception.
+        
+        :returns: list with a (result, exc_info) tuple for each item, in the 
+        same order as items. exc_info is None if the call succeeded.
+        """
+        
+        func = self._bind_deadline(func)
+        if max_workers <= 1 or len(items) <= 1:
+            results = []
+            for item in items:
+                try:
+                    results.append((func(item), None))
+                except Exception:
+                    results.append((None, sys.exc_info()))
+                    if stop_on_error:
+                        break
+            # items not started share the error of the failed item
+            while len(results) < len(items):
+                results.append((None, results[-1][1]))
+            return results
+        
+        results = [(None, None)] * len(items)
+        pending = Queue.Queue()
+        for index, item in enumerate(items):
+            pending.put((index, item))
+        failed = []
+        
+        def _worker():
+            while not (stop_on_error and failed):
+                try:
+                    index, item = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    results[index] = (func(item), None)
+                except Exception:
+                    results[index] = (None, sys.exc_info())
+                    failed.append(index)
+        
+        threads = [
+            self._start_worker(_worker) 
+            for _ in range(min(max_workers, len(items)))
+        ]
+        for t in threads:
+            t.join()
+        
+        # items not started because of an earlier failure share its error
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                break
+            results[index] = (None, results[failed[0]][1])
+        return results
     # ========================================================================
     # Utility
 
@@ -1250,7 +2878,8 @@ class Shotgun(object):
         
         if not isinstance(records, (list, tuple)):
             records=[records,]
-            
+        
+        thumbnails = []
         for rec in records:
             # skip results that aren't entity dictionaries
             if not isinstance(rec, dict):
@@ -1261,10 +2890,9 @@ class Shotgun(object):
                 if not v:
                     continue
                     
-                # check for thumbnail
+                # check for thumbnail, the urls are looked up together
                 if k == 'image':
-                    rec['image'] = self._build_thumb_url(rec['type'], 
-                        rec['id'])
+                    thumbnails.append(rec)
                     continue
                     
                 if isinstance(v, dict) and v.get('link_type') == 'local' \
@@ -1273,8 +2901,59 @@ class Shotgun(object):
                     v['local_path'] = local_path
                     v['url'] = "file://%s" % (local_path or "",)
         
+        if thumbnails and self.config.lazy_thumbnails:
+            for rec in thumbnails:
+                rec['image'] = ThumbnailUrl(self, rec['type'], rec['id'])
+        elif thumbnails:
+            self._set_thumb_urls(thumbnails)
         return records
     
+    def _set_thumb_urls(self, records):
+        """Sets the image field of the records to the url of the entity's 
+        thumbnail. 
+        
+        Urls are looked up using up to config.max_thumbnail_workers threads, 
+        and cached by entity type and id if config.thumbnail_cache_secs is 
+        set.
+        """
+        urls = {}
+        missing = []
+        for rec in records:
+            key = (rec['type'], rec['id'])
+            if key in urls:
+                continue
+            urls[key] = self._thumb_urls.get(key)
+            if urls[key] is None:
+                missing.append(key)
+        
+        results = self._run_concurrent(
+            lambda key: self._build_thumb_url(*key), missing, 
+            self.config.max_thumbnail_workers, stop_on_error=True)
+        for key, (url, exc_info) in zip(missing, results):
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._cache_thumb_url(key, url)
+            urls[key] = url
+        
+        for rec in records:
+            rec['image'] = urls[(rec['type'], rec['id'])]
+    
+    def _thumb_url(self, entity_type, entity_id):
+        """Returns the cached URL for the thumbnail of an entity, looking it
+        up if it is not in the cache."""
+        key = (entity_type, entity_id)
+        url = self._thumb_urls.get(key)
+        if url is None:
+            url = self._build_thumb_url(entity_type, entity_id)
+            self._cache_thumb_url(key, url)
+        return url
+    
+    def _cache_thumb_url(self, key, url):
+        """Caches the url for config.thumbnail_cache_secs, unless it is 0."""
+        ttl = self.config.thumbnail_cache_secs
+        if ttl is None or ttl > 0:
+            self._thumb_urls.set(key, url, ttl)
+    
     def _build_thumb_url(self, entity_type, entity_id):
         """Returns the URL for the thumbnail of an entity given the
         entity type and the entity id.
@@ -1324,75 +3003,2000 @@ class Shotgun(object):
             for k,v in (d or {}).iteritems()
         ]
 
- 
-# Helpers from the previous API, left as is. 
-
-# Based on http://code.activestate.com/recipes/146306/
-class FormPostHandler(urllib2.BaseHandler):
+class EventStream(object):
+    """Follows the EventLogEntry records on the server in id order. 
+    
+    Events are read in batches of the events with an id greater than the 
+    cursor, the id of the last event handled. When a full batch is read the 
+    stream is behind, so the batch size doubles up to max_batch. When it 
+    has caught up the batch size drops back to min_batch, and when there 
+    are no new events the wait before reading again doubles from 
+    min_poll_secs up to max_poll_secs.
+    
+    If cursor_path is given the cursor is saved to that file after each 
+    batch, and read from it when the stream is created, so a restarted 
+    process carries on where it stopped. 
+    
+    e.g. 
+    stream = EventStream(sg, cursor_path="/var/run/my_daemon.cursor")
+    stream.run(handle_event)
     """
-    Handler for multipart form data
+    
+    FIELDS = ["event_type", "entity", "attribute_name", "meta", "user", 
+        "project", "created_at", "description"]
+    
+    def __init__(self, sg, fields=None, filters=None, cursor=None, 
+        cursor_path=None, min_batch=50, max_batch=1000, min_poll_secs=1, 
+        max_poll_secs=60):
+        """EventStream.__init__
+        
+        :param sg: Shotgun client to read the events with. 
+        
+        :param fields: Optional, list of event fields to read. Defaults to 
+        EventStream.FIELDS.
+        
+        :param filters: Optional, list of filters the events must match, 
+        e.g. [['event_type', 'is', 'Shotgun_Shot_Change']].
+        
+        :param cursor: Optional, id of the last event handled, the stream 
+        starts after it. Ignored if the cursor file exists. Defaults to the 
+        latest event on the server. 
+        
+        :param cursor_path: Optional, path of the file to save the cursor in.
+        
+        :param min_batch, max_batch: Optional, range of the number of events
+        to read at once. 
+        
+        :param min_poll_secs, max_poll_secs: Optional, range of the seconds 
+        to wait before reading again when there are no new events.
+        """
+        self.sg = sg
+        self.fields = fields or self.FIELDS
+        self.filters = filters or []
+        self.cursor_path = cursor_path
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.min_poll_secs = min_poll_secs
+        self.max_poll_secs = max_poll_secs
+        self.batch_size = min_batch
+        self.poll_secs = min_poll_secs
+        self.behind = False
+        self._stop = threading.Event()
+        
+        self.cursor = self._read_cursor()
+        if self.cursor is None:
+            self.cursor = cursor
+        if self.cursor is None:
+            self.cursor = _latest_event_id(sg)
+    
+    def __iter__(self):
+        """Yields the events in order until stop() is called. The cursor 
+        moves past an event when the next event is asked for."""
+        while not self._stop.isSet():
+            events = self.read_batch()
+            for event in events:
+                yield event
+                self.cursor = event["id"]
+                if self._stop.isSet():
+                    break
+            self.checkpoint()
+            self._wait(events)
+    
+    def run(self, handler):
+        """Calls handler with each event in order until stop() is called. 
+        
+        If handler raises an exception the cursor is saved at the last event
+        handled and the exception is raised. 
+        """
+        try:
+            for event in self:
+                handler(event)
+        finally:
+            self.checkpoint()
+    
+    def stop(self):
+        """Stops the stream, it can be called from another thread."""
+        self._stop.set()
+    
+    def read_batch(self):
+        """Reads the next batch of events after the cursor, the cursor is 
+        not moved. behind is set if the batch was full. 
+        
+        :returns: list of the event dicts in id order. 
+        """
+        events = self.sg.find("EventLogEntry", self.filters, self.fields, 
+            limit=self.batch_size, pagination="keyset", cursor=self.cursor)
+        self.behind = len(events) >= self.batch_size
+        if self.behind:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
+        else:
+            self.batch_size = self.min_batch
+        return events
+    
+    def checkpoint(self):
+        """Saves the cursor to cursor_path."""
+        if not self.cursor_path or self.cursor is None:
+            return
+        _write_file_atomic(self.cursor_path, str(self.cursor))
+    
+    def _read_cursor(self):
+        if not self.cursor_path or not os.path.exists(self.cursor_path):
+            return None
+        f = open(self.cursor_path, "rb")
+        try:
+            return int(f.read().strip())
+        finally:
+            f.close()
+    
+    def _wait(self, events):
+        """Waits before reading again, backing off while there are no 
+        events. Does not wait if the stream is behind."""
+        if not events:
+            self._stop.wait(self.poll_secs)
+            self.poll_secs = min(self.max_poll_secs, self.poll_secs * 2)
+            return
+        self.poll_secs = self.min_poll_secs
+        if not self.behind:
+            self._stop.wait(self.min_poll_secs)
+
+def _latest_event_id(sg):
+    """Returns the id of the latest EventLogEntry, or 0 if there are none."""
+    latest = sg.find_one("EventLogEntry", [], ["id"], 
+        order=[{"field_name" : "id", "direction" : "desc"}])
+    return (latest and latest["id"]) or 0
+
+class EventCacheInvalidator(object):
+    """Keeps a client's caches current by following the EventLogEntry 
+    records for changes made by any client. 
+    
+    A background thread reads the new events every poll_secs and for each 
+    changed entity invalidates the cached results for its entity type, and 
+    the cached thumbnail url if its image changed. This allows results to be
+    cached for longer, see config.cache_results. 
+    
+    Results that include fields of linked entities are only invalidated 
+    when an entity of the type queried changes.
     """
-    handler_order = urllib2.HTTPHandler.handler_order - 10 # needs to run first
     
-    def http_request(self, request):
-        data = request.get_data()
-        if data is not None and not isinstance(data, basestring):
-            files = []
-            params = []
-            for key, value in data.items():
-                if isinstance(value, file):
-                    files.append((key, value))
-                else:
-                    params.append((key, value))
-            if not files:
-                data = urllib.urlencode(params, True) # sequencing on
-            else:
-                boundary, data = self.encode(params, files)
-                content_type = 'multipart/form-data; boundary=%s' % boundary
-                request.add_unredirected_header('Content-Type', content_type)
-            request.add_data(data)
-        return request
+    _EVENT_FIELDS = ["event_type", "entity", "attribute_name", "meta"]
     
-    def encode(self, params, files, boundary=None, buffer=None):
-        if boundary is None:
-            boundary = mimetools.choose_boundary()
-        if buffer is None:
-            buffer = cStringIO.StringIO()
-        for (key, value) in params:
-            buffer.write('--%s\r\n' % boundary)
-            buffer.write('Content-Disposition: form-data; name="%s"' % key)
-            buffer.write('\r\n\r\n%s\r\n' % value)
-        for (key, fd) in files:
-            filename = fd.name.split('/')[-1]
-            content_type = mimetypes.guess_type(filename)[0]
-            content_type = content_type or 'application/octet-stream'
-            file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-            buffer.write('--%s\r\n' % boundary)
-            c_dis = 'Content-Disposition: form-data; name="%s"; filename="%s"%s'
-            content_disposition = c_dis % (key, filename, '\r\n')
-            buffer.write(content_disposition)
-            buffer.write('Content-Type: %s\r\n' % content_type)
-            buffer.write('Content-Length: %s\r\n' % file_size)
-            fd.seek(0)
-            buffer.write('\r\n%s\r\n' % fd.read())
-        buffer.write('--%s--\r\n\r\n' % boundary)
-        buffer = buffer.getvalue()
-        return boundary, buffer
+    def __init__(self, sg, poll_secs=5, batch_size=500):
+        """EventCacheInvalidator.__init__
+        
+        :param sg: Shotgun client whose caches are invalidated. 
+        
+        :param poll_secs: Optional, seconds between reading new events.
+        
+        :param batch_size: Optional, maximum number of events read at once.
+        """
+        self.sg = sg
+        self.poll_secs = poll_secs
+        # the cursor is moved to the latest event by start() or the first 
+        # poll(), unless it is set before then
+        self.stream = EventStream(sg, self._EVENT_FIELDS, cursor=0, 
+            min_batch=batch_size, max_batch=batch_size)
+        self._following = False
+        self._stop = threading.Event()
+        self._thread = None
     
-    def https_request(self, request):
-        return self.http_request(request)
+    def _get_cursor(self):
+        return self.stream.cursor
+    
+    def _set_cursor(self, cursor):
+        self.stream.cursor = cursor
+        self._following = True
+    
+    # id of the last event processed
+    cursor = property(_get_cursor, _set_cursor)
+    
+    def start(self):
+        """Starts following events from the latest event. 
+        
+        The client's caches are cleared as changes made before the start 
+        are not known.
+        """
+        if self._thread is not None:
+            return
+        self._follow_latest()
+        self._stop.clear()
+        self._thread = self.sg._start_worker(self._run)
+    
+    def stop(self):
+        """Stops following events."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def poll(self):
+        """Reads the events since the last poll and invalidates the cached 
+        data they change. 
+        
+        The first poll starts from the latest event and clears the client's 
+        caches, as start() does, unless the cursor has been set. 
+        
+        :returns: Number of events processed.
+        """
+        if not self._following:
+            self._follow_latest()
+        events = self.stream.read_batch()
+        for event in events:
+            self.invalidate_event(event)
+            self.cursor = event["id"]
+        return len(events)
+    
+    def invalidate_event(self, event):
+        """Invalidates the cached data changed by an EventLogEntry."""
+        entity_type, entity_id = _event_entity(event)
+        if not entity_type:
+            return
+        self.sg.invalidate_cache(entity_type)
+        if event.get("attribute_name") == "image" and entity_id:
+            self.sg._thumb_urls.invalidate((entity_type, entity_id))
+    
+    def _follow_latest(self):
+        """Moves the cursor to the latest event and clears the caches, as 
+        changes made before it are not known."""
+        self.cursor = _latest_event_id(self.sg)
+        self._invalidate_all()
+    
+    def _invalidate_all(self):
+        self.sg.invalidate_cache()
+        self.sg._thumb_urls.invalidate()
+    
+    def _run(self):
+        while not self._stop.isSet():
+            try:
+                # keep reading while there is a backlog of events
+                while self.poll() >= self.stream.max_batch and \
+                    not self._stop.isSet():
+                    pass
+            except Exception:
+                # changes may have been missed, nothing cached can be trusted
+                LOG.exception("Error reading events, clearing caches")
+                self._invalidate_all()
+            self._stop.wait(self.poll_secs)
+
+def _event_entity(event):
+    """Returns the (entity type, entity id) changed by an EventLogEntry, the 
+    values are None if they are not known. 
+    
+    The type is taken from the event meta data, the event entity, or the 
+    event type, which has the form Shotgun_<entity type>_<action>.
+    """
+    meta = event.get("meta") or {}
+    entity = event.get("entity") or {}
+    entity_type = meta.get("entity_type") or entity.get("type")
+    entity_id = meta.get("entity_id") or entity.get("id")
+    if not entity_type:
+        parts = (event.get("event_type") or "").split("_")
+        if len(parts) >= 3 and parts[0] == "Shotgun":
+            entity_type = "_".join(parts[1:-1])
+    return entity_type or None, entity_id or None
 
+class _NotReplicated(Exception):
+    """Raised when a query cannot be answered from the replica."""
+    pass
 
-def _translate_filters(filters, filter_operator):
-    '''_translate_filters translates filters params into data structure
-    expected by rpc call.'''
-    new_filters = {}
+class Replica(object):
+    """Local copy of chosen entity types in a SQLite database. 
+    
+    sync() first copies every entity of each type, then on later calls only
+    reads the entities changed since the last sync. find() and find_one() 
+    take the same arguments as the client methods and query the local copy, 
+    queries it cannot answer, such as ones that use fields that are not 
+    copied, are passed on to the server. 
+    
+    Changes are found from the EventLogEntry records, or when use_events is
+    False from the updated_at field of each type, which does not find 
+    retired entities. The values of linked fields, e.g. 'entity.Shot.code',
+    are only updated when the entity they are read from changes. 
+    
+    e.g. 
+    replica = Replica(sg, "/var/tmp/assets.db", 
+        {"Asset" : ["code", "sg_asset_type", "project", "tags"]})
+    replica.sync()
+    replica.find("Asset", [["sg_asset_type", "is", "Prop"]], ["code"])
+    """
+    
+    _META = "_replica_meta"
+    _LINKS = "_replica_links"
+    _ACTIONS = ["New", "Change", "Retirement", "Revival"]
+    _BATCH_SIZE = 500
+    
+    def __init__(self, sg, path, entities, use_events=True):
+        """Replica.__init__
         
-    if not filter_operator or filter_operator == "all":
-        new_filters["logical_operator"] = "and"
-    else:
+        :param sg: Shotgun client to read the entities with. 
+        
+        :param path: Path of the SQLite database file, it is created if 
+        needed. 
+        
+        :param entities: dict of the entity types to copy to the list of 
+        fields to copy for each. 
+        
+        :param use_events: Optional, if True changes are found from the 
+        event log, otherwise from the updated_at field. Defaults to True.
+        """
+        if sqlite3 is None:
+            raise ShotgunError("Replica requires the sqlite3 module")
+        self.sg = sg
+        self.path = path
+        self.use_events = use_events
+        self.entities = {}
+        for entity_type, fields in entities.iteritems():
+            fields = [f for f in fields if f not in ("type", "id")]
+            if not use_events and "updated_at" not in fields:
+                fields.append("updated_at")
+            self.entities[entity_type] = fields
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # records are utf-8 byte strings
+        self._db.text_factory = str
+        self._db.create_function("_sg_match", 2, self._sql_match)
+        self._matches = []
+        self._match_now = None
+        self._open()
+    
+    def sync(self):
+        """Copies the changes made on the server since the last sync. 
+        
+        The changes are read from the server before they are written to the 
+        replica in one transaction, queries are only blocked while they are 
+        written. 
+        
+        :returns: Number of entities updated or removed. 
+        """
+        self._sync_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                synced = self._get_meta("synced")
+                cursor = self._get_meta("cursor")
+            finally:
+                self._lock.release()
+            
+            if synced is None or (self.use_events and cursor is None):
+                changes, cursor = self._read_all()
+            elif self.use_events:
+                changes, cursor = self._read_events(int(cursor))
+            else:
+                changes, cursor = self._read_updated(), None
+            
+            self._lock.acquire()
+            try:
+                try:
+                    count = self._write(changes, cursor)
+                    self._set_meta("synced", time.time())
+                    self._db.commit()
+                except:
+                    self._db.rollback()
+                    raise
+                return count
+            finally:
+                self._lock.release()
+        finally:
+            self._sync_lock.release()
+    
+    def start(self, poll_secs=30):
+        """Syncs the replica every poll_secs on a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = self.sg._start_worker(
+            lambda: self._run(poll_secs))
+    
+    def stop(self):
+        """Stops syncing the replica in the background."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def close(self):
+        """Stops syncing and closes the database."""
+        self.stop()
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+    
+    def find_one(self, entity_type, filters, fields=None, order=None, 
+        filter_operator=None, retired_only=False):
+        """Returns the first entity that matches, or None. See find()."""
+        results = self.find(entity_type, filters, fields, order, 
+            filter_operator, 1, retired_only)
+        if results:
+            return results[0]
+        return None
+    
+    def find(self, entity_type, filters, fields=None, order=None, 
+        filter_operator=None, limit=0, retired_only=False, page=0):
+        """Find entities matching the given filters in the replica. 
+        
+        Takes the same parameters as Shotgun.find(). The query is passed on 
+        to the server if the entity type or a field used is not copied, if 
+        a filter uses a relation the replica does not support, if 
+        retired_only is set, or if the replica has not been synced.
+        
+        :returns: list of the dicts for each entity with the requested fields,
+        and their id and type. 
+        """
+        if not isinstance(limit, int) or limit < 0:
+            raise ValueError("limit parameter must be a positive integer")
+        if not isinstance(page, int) or page < 0:
+            raise ValueError("page parameter must be a positive integer")
+        
+        self._lock.acquire()
+        try:
+            try:
+                return self._find(entity_type, filters, fields or ["id"], 
+                    order, filter_operator, limit, retired_only, page)
+            except _NotReplicated, e:
+                LOG.debug("Reading %s from the server, %s" % (entity_type, e))
+        finally:
+            self._lock.release()
+        return self.sg.find(entity_type, filters, fields, order, 
+            filter_operator, limit, retired_only, page)
+    
+    # ========================================================================
+    # Sync
+    
+    def _open(self):
+        """Creates the tables, or recreates them if the types or fields 
+        replicated have changed."""
+        self._execute('CREATE TABLE IF NOT EXISTS %s '\
+            '(key TEXT PRIMARY KEY, value TEXT)' % self._META)
+        config = json.dumps(self.entities, sort_keys=True)
+        if self._get_meta("entities") != config:
+            tables = self._execute("SELECT name FROM sqlite_master "\
+                "WHERE type = 'table' AND name != ?", (self._META,)).fetchall()
+            for (table,) in tables:
+                self._execute("DROP TABLE %s" % _sql_name(table))
+            self._execute("DELETE FROM %s" % self._META)
+            self._set_meta("entities", config)
+        
+        self._execute('CREATE TABLE IF NOT EXISTS %s (entity_type TEXT, '\
+            'id INTEGER, field TEXT, value)' % self._LINKS)
+        self._execute('CREATE INDEX IF NOT EXISTS %s ON %s '\
+            '(entity_type, field, value)' % (
+            _sql_name(self._LINKS + "_value"), self._LINKS))
+        self._execute('CREATE INDEX IF NOT EXISTS %s ON %s '\
+            '(entity_type, id)' % (_sql_name(self._LINKS + "_id"), 
+            self._LINKS))
+        for entity_type, fields in self.entities.iteritems():
+            columns = ["id INTEGER PRIMARY KEY", "_record BLOB"]
+            columns.extend(_sql_name(f) for f in fields)
+            self._execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (
+                _sql_name(entity_type), ", ".join(columns)))
+        self._db.commit()
+        self._list_fields = json.loads(self._get_meta("list_fields") or "{}")
+    
+    # Each sync reads a list of changes, (entity_type, clear, ids, records) 
+    # tuples, where clear removes every entity of the type and ids are the 
+    # entities to remove before the records are stored.
+    
+    def _read_all(self):
+        """Reads every entity of each type. 
+        
+        :returns: Tuple of the changes and the event cursor, or None if 
+        use_events is False. 
+        """
+        cursor = None
+        if self.use_events:
+            # events after this are replayed by the next sync
+            cursor = _latest_event_id(self.sg)
+        changes = []
+        for entity_type, fields in self.entities.iteritems():
+            records = list(self.sg.find_iter(entity_type, [], fields, 
+                pagination="keyset"))
+            changes.append((entity_type, True, [], records))
+        return changes, cursor
+    
+    def _read_events(self, cursor):
+        """Reads the entities changed by the events after the cursor. 
+        
+        :returns: Tuple of the changes and the id of the last event read. 
+        """
+        event_types = []
+        for entity_type in self.entities:
+            event_types.extend("Shotgun_%s_%s" % (entity_type, action) 
+                for action in self._ACTIONS)
+        stream = EventStream(self.sg, ["event_type", "entity", "meta"], 
+            [["event_type", "in", event_types]], cursor=cursor, 
+            min_batch=self._BATCH_SIZE, max_batch=self._BATCH_SIZE)
+        
+        changed = {}
+        while True:
+            events = stream.read_batch()
+            for event in events:
+                entity_type, entity_id = _event_entity(event)
+                if entity_type in self.entities and entity_id:
+                    ids = changed.setdefault(entity_type, set())
+                    ids.add(entity_id)
+                stream.cursor = event["id"]
+            if not stream.behind:
+                break
+        
+        changes = []
+        for entity_type, ids in changed.iteritems():
+            changes.extend(self._read_ids(entity_type, sorted(ids)))
+        return changes, stream.cursor
+    
+    def _read_ids(self, entity_type, ids):
+        """Reads the entities again, those that are retired are removed."""
+        changes = []
+        for start in range(0, len(ids), self._BATCH_SIZE):
+            batch = ids[start:start + self._BATCH_SIZE]
+            records = self.sg.find(entity_type, [["id", "in", batch]], 
+                self.entities[entity_type])
+            changes.append((entity_type, False, batch, records))
+        return changes
+    
+    def _read_updated(self):
+        """Reads the entities whose updated_at time is after the latest 
+        copied."""
+        changes = []
+        for entity_type, fields in self.entities.iteritems():
+            self._lock.acquire()
+            try:
+                latest = self._execute('SELECT max("updated_at") FROM %s' % 
+                    _sql_name(entity_type)).fetchone()[0]
+            finally:
+                self._lock.release()
+            filters = []
+            if latest:
+                # times only have seconds, include changes in the same second
+                latest = datetime.datetime(
+                    *time.strptime(latest, "%Y-%m-%dT%H:%M:%SZ")[:6])
+                latest = latest.replace(tzinfo=SG_TIMEZONE.utc) - \
+                    datetime.timedelta(seconds=1)
+                filters = [["updated_at", "greater_than", latest]]
+            records = list(self.sg.find_iter(entity_type, filters, fields, 
+                pagination="keyset"))
+            changes.append((entity_type, False, [r["id"] for r in records], 
+                records))
+        return changes
+    
+    def _write(self, changes, cursor):
+        """Writes the changes read from the server to the replica. 
+        
+        :returns: Number of entities updated or removed. 
+        """
+        count = 0
+        for entity_type, clear, ids, records in changes:
+            if clear:
+                self._execute("DELETE FROM %s" % _sql_name(entity_type))
+                self._execute("DELETE FROM %s WHERE entity_type = ?" % 
+                    self._LINKS, (entity_type,))
+            for entity_id in ids:
+                self._remove(entity_type, entity_id)
+            for record in records:
+                self._store(entity_type, record)
+            count += len(ids or records)
+        if cursor is not None:
+            self._set_meta("cursor", cursor)
+        return count
+    
+    def _store(self, entity_type, record):
+        fields = self.entities[entity_type]
+        values = self.sg._transform_outbound(dict(
+            (f, _replica_value(record.get(f))) for f in fields))
+        row = [record["id"], sqlite3.Binary(cPickle.dumps(
+            _replica_record(record), 2))]
+        for field in fields:
+            value = values.get(field)
+            if isinstance(value, list):
+                self._add_list_field(entity_type, field)
+                self._db.executemany("INSERT INTO %s VALUES (?, ?, ?, ?)" % 
+                    self._LINKS, [(entity_type, record["id"], field, 
+                    _sql_value(v)) for v in value])
+                value = None
+            row.append(_sql_value(value))
+        self._execute("INSERT OR REPLACE INTO %s VALUES (%s)" % (
+            _sql_name(entity_type), ", ".join("?" * len(row))), row)
+    
+    def _remove(self, entity_type, entity_id):
+        self._execute("DELETE FROM %s WHERE id = ?" % 
+            _sql_name(entity_type), (entity_id,))
+        self._execute("DELETE FROM %s WHERE entity_type = ? AND id = ?" % 
+            self._LINKS, (entity_type, entity_id))
+    
+    def _add_list_field(self, entity_type, field):
+        list_fields = self._list_fields.setdefault(entity_type, [])
+        if field not in list_fields:
+            list_fields.append(field)
+            self._set_meta("list_fields", json.dumps(self._list_fields))
+    
+    def _run(self, poll_secs):
+        while not self._stop.isSet():
+            try:
+                self.sync()
+            except Exception:
+                LOG.exception("Error syncing the replica %s" % self.path)
+            self._stop.wait(poll_secs)
+    
+    # ========================================================================
+    # Queries
+    
+    def _find(self, entity_type, filters, fields, order, filter_operator, 
+        limit, retired_only, page):
+        if entity_type not in self.entities:
+            raise _NotReplicated("entity type is not replicated")
+        if retired_only:
+            raise _NotReplicated("retired entities are not replicated")
+        if self._get_meta("synced") is None:
+            raise _NotReplicated("replica has not been synced")
+        columns = self.entities[entity_type]
+        for field in fields:
+            if field not in columns and field not in ("type", "id"):
+                raise _NotReplicated("field %s is not replicated" % field)
+        
+        if isinstance(filters, (list, tuple)):
+            filters = _translate_filters(filters, filter_operator)
+        elif filter_operator:
+            raise ShotgunError("Deprecated: Use of filter_operator for find()"
+                " is not valid any more. See the documentation on find()")
+        args = []
+        self._matches = []
+        self._match_now = datetime.datetime.now()
+        sql = "SELECT id, _record FROM %s WHERE %s" % (
+            _sql_name(entity_type), 
+            self._filters_sql(entity_type, filters, args))
+        
+        sorts = []
+        for sort in order or []:
+            field = sort["field_name"]
+            if field != "id" and (field not in columns or 
+                self._is_list_field(entity_type, field)):
+                raise _NotReplicated("cannot order by %s" % field)
+            direction = (sort.get("direction") or "asc").upper()
+            if direction not in ("ASC", "DESC"):
+                raise ShotgunError("sort direction must be 'asc' or 'desc'")
+            sorts.append("%s %s" % (_sql_name(field), direction))
+        sorts.append("id ASC")
+        sql += " ORDER BY " + ", ".join(sorts)
+        
+        if page:
+            # pages are the same size as those read by Shotgun.find()
+            page_size = min(limit or self.sg.config.records_per_page, 
+                self.sg.config.records_per_page)
+            sql += " LIMIT %d OFFSET %d" % (page_size, (page - 1) * page_size)
+        elif limit:
+            sql += " LIMIT %d" % limit
+        
+        results = []
+        for entity_id, blob in self._execute(sql, args):
+            record = cPickle.loads(str(blob))
+            result = {"type" : entity_type, "id" : entity_id}
+            for field in fields:
+                if field not in ("type", "id"):
+                    result[field] = _replica_field(self.sg, 
+                        record.get(field))
+            results.append(result)
+        return results
+    
+    def _filters_sql(self, entity_type, filters, args):
+        """Returns the SQL expression for the filters, the values used are 
+        appended to args."""
+        conditions = filters.get("conditions") or []
+        if not conditions:
+            return "1"
+        operator = " AND "
+        if filters.get("logical_operator") == "or":
+            operator = " OR "
+        exprs = []
+        for condition in conditions:
+            if "conditions" in condition:
+                exprs.append(self._filters_sql(entity_type, condition, args))
+            else:
+                exprs.append(self._condition_sql(entity_type, condition, 
+                    args))
+        return "(%s)" % operator.join(exprs)
+    
+    def _condition_sql(self, entity_type, condition, args):
+        path = condition["path"]
+        relation = condition["relation"]
+        if path != "id" and path not in self.entities[entity_type]:
+            raise _NotReplicated("field %s is not replicated" % path)
+        values = self.sg._transform_outbound(list(condition["values"]))
+        if relation in ("in", "not_in") and len(values) == 1 and \
+            isinstance(values[0], (list, tuple)):
+            values = values[0]
+        values = [_sql_value(v) for v in values]
+        
+        if self._is_list_field(entity_type, path):
+            return self._list_condition_sql(entity_type, condition, values, 
+                args)
+        
+        column = _sql_name(path)
+        if relation in ("is", "is_not") and values[0] is None:
+            if relation == "is":
+                return "%s IS NULL" % column
+            return "%s IS NOT NULL" % column
+        if relation in _SQL_RELATIONS:
+            sql = _SQL_RELATIONS[relation]
+            args.extend(values[:sql.count("?")])
+            return sql.replace("%s", column)
+        if relation in _SQL_LIKE_RELATIONS:
+            sql, pattern = _SQL_LIKE_RELATIONS[relation]
+            args.append(pattern % _sql_escape_like(values[0]))
+            return sql.replace("%s", column)
+        if relation in ("in", "not_in"):
+            if not values:
+                return {"in" : "0", "not_in" : "1"}[relation]
+            args.extend(values)
+            sql = "%s IN (%s)" % (column, ", ".join("?" * len(values)))
+            if relation == "in":
+                return sql
+            return "(%s IS NULL OR NOT %s)" % (column, sql)
+        return self._match_sql(condition, args)
+    
+    def _list_condition_sql(self, entity_type, condition, values, args):
+        """SQL for a filter on a field with a list of values, such as a 
+        multi entity field."""
+        relation = condition["relation"]
+        if relation not in ("is", "is_not", "in", "not_in"):
+            return self._match_sql(condition, args)
+        sql = "id IN (SELECT id FROM %s WHERE entity_type = ? "\
+            "AND field = ?" % self._LINKS
+        args.extend([entity_type, condition["path"]])
+        if relation in ("is", "is_not") and values[0] is None:
+            sql += ")"
+            negate = relation == "is"
+        else:
+            args.extend(values)
+            sql += " AND value IN (%s))" % ", ".join("?" * len(values))
+            negate = relation in ("is_not", "not_in")
+        if negate:
+            return "NOT " + sql
+        return sql
+    
+    def _match_sql(self, condition, args):
+        """SQL that matches the stored records to the condition in python, 
+        for relations that cannot be written in SQL such as in_last."""
+        if condition["relation"] not in _FILTER_RELATIONS:
+            raise _NotReplicated("relation %s is not supported" % 
+                condition["relation"])
+        args.append(len(self._matches))
+        self._matches.append({"logical_operator" : "and", 
+            "conditions" : [condition]})
+        return "_sg_match(?, _record)"
+    
+    def _sql_match(self, index, blob):
+        return _match_filters(self._matches[index], 
+            cPickle.loads(str(blob)), self._match_now)
+    
+    def _is_list_field(self, entity_type, field):
+        return field in self._list_fields.get(entity_type, [])
+    
+    def _get_meta(self, key):
+        row = self._execute("SELECT value FROM %s WHERE key = ?" % 
+            self._META, (key,)).fetchone()
+        return row and row[0]
+    
+    def _set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO %s VALUES (?, ?)" % 
+            self._META, (key, str(value)))
+    
+    def _execute(self, sql, args=()):
+        return self._db.execute(sql, args)
+
+# SQL for the relations that compare the column to the filter values
+_SQL_RELATIONS = {
+    "is" : "%s = ?",
+    "is_not" : "(%s IS NULL OR %s != ?)",
+    "less_than" : "%s < ?",
+    "greater_than" : "%s > ?",
+    "between" : "%s BETWEEN ? AND ?",
+    "not_between" : "(%s IS NULL OR %s NOT BETWEEN ? AND ?)",
+}
+
+# SQL and LIKE pattern for the relations that match text
+_SQL_LIKE_RELATIONS = {
+    "contains" : ("%s LIKE ? ESCAPE '\\'", "%%%s%%"),
+    "not_contains" : ("(%s IS NULL OR %s NOT LIKE ? ESCAPE '\\')", 
+        "%%%s%%"),
+    "starts_with" : ("%s LIKE ? ESCAPE '\\'", "%s%%"),
+    "ends_with" : ("%s LIKE ? ESCAPE '\\'", "%%%s"),
+    "type_is" : ("%s LIKE ? ESCAPE '\\'", "%s:%%"),
+    "type_is_not" : ("(%s IS NULL OR %s NOT LIKE ? ESCAPE '\\')", "%s:%%"),
+}
+
+def _sql_name(name):
+    """Quotes a table or column name."""
+    return '"%s"' % name.replace('"', '""')
+
+def _sql_escape_like(value):
+    if not isinstance(value, basestring):
+        value = str(value)
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+def _sql_value(value):
+    """Converts a field or filter value to the value stored in the replica, 
+    entities are stored as 'type:id'."""
+    if isinstance(value, dict) and "type" in value and "id" in value:
+        return "%s:%s" % (value["type"], value["id"])
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+def _replica_value(value):
+    """Value of a field to query, the entity for a thumbnail."""
+    if isinstance(value, ThumbnailUrl):
+        return None
+    return value
+
+def _replica_record(record):
+    """Copy of the record that can be pickled, thumbnails that have not been
+    looked up are stored as a tuple."""
+    record = dict(record)
+    for key, value in record.iteritems():
+        if isinstance(value, ThumbnailUrl):
+            record[key] = (value.entity_type, value.entity_id)
+    return record
+
+def _replica_field(sg, value):
+    if isinstance(value, tuple):
+        return ThumbnailUrl(sg, *value)
+    return value
+
+def _async_method(name):
+    """Creates an AsyncShotgun method that submits Shotgun.<name>()."""
+    def _method(self, *args, **kwargs):
+        return self.submit(getattr(self.sg, name), *args, **kwargs)
+    _method.__name__ = name
+    _method.__doc__ = "Calls Shotgun.%s() on a background thread, returns a "\
+        "_Future for the result." % name
+    return _method
+
+class AsyncShotgun(object):
+    """Shotgun client whose calls run on a pool of background threads. 
+    
+    Each API method takes the same arguments as the Shotgun method of the 
+    same name, but returns at once with a future. The future's result() 
+    waits for and returns the value of the call, or raises its exception. 
+    Any number of calls can be in flight, they are run by up to max_workers 
+    threads which share the client's connection pool. 
+    
+    e.g. 
+    shots = async_sg.find("Shot", [["project", "is", project]])
+    assets = async_sg.find("Asset", [["project", "is", project]])
+    print len(shots.result()), len(assets.result())
+    """
+    
+    def __init__(self, sg, max_workers=None):
+        """AsyncShotgun.__init__
+        
+        :param sg: Shotgun client used to make the calls. 
+        
+        :param max_workers: Optional, number of threads to run calls on. 
+        Defaults to config.connection_pool_size of the client. 
+        """
+        self.sg = sg
+        self._workers = _WorkerPool(sg, 
+            max_workers or sg.config.connection_pool_size)
+    
+    def submit(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) on a background thread. 
+        
+        :returns: _Future for the result of the call. 
+        """
+        return self._workers.submit(func, *args, **kwargs)
+    
+    def close(self):
+        """Stops the background threads once the queued calls have run and 
+        closes the client's connections."""
+        self._workers.shutdown()
+        self.sg.close()
+    
+    info = _async_method("info")
+    find = _async_method("find")
+    find_one = _async_method("find_one")
+    find_many = _async_method("find_many")
+    summarize = _async_method("summarize")
+    create = _async_method("create")
+    update = _async_method("update")
+    delete = _async_method("delete")
+    revive = _async_method("revive")
+    batch = _async_method("batch")
+    schema_read = _async_method("schema_read")
+    schema_entity_read = _async_method("schema_entity_read")
+    schema_field_read = _async_method("schema_field_read")
+    schema_field_create = _async_method("schema_field_create")
+    schema_field_update = _async_method("schema_field_update")
+    schema_field_delete = _async_method("schema_field_delete")
+    upload = _async_method("upload")
+    upload_thumbnail = _async_method("upload_thumbnail")
+    download_attachment = _async_method("download_attachment")
+
+class _Future(object):
+    """Result of a call that is running on another thread."""
+    
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    def done(self):
+        """Returns True if the call has finished."""
+        return self._done.isSet()
+    
+    def result(self, timeout=None):
+        """Waits for the call to finish and returns its result. 
+        
+        :param timeout: Optional, seconds to wait. Defaults to waiting until 
+        the call finishes. 
+        
+        :raises: The exception raised by the call, or ShotgunError if it did 
+        not finish within the timeout. 
+        """
+        exc_info = self._wait(timeout)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._result
+    
+    def exception(self, timeout=None):
+        """Waits for the call to finish and returns the exception it raised,
+        or None if it succeeded."""
+        exc_info = self._wait(timeout)
+        return exc_info and exc_info[1]
+    
+    def add_done_callback(self, func):
+        """Calls func with this future once the call has finished, at once 
+        if it already has. The callback runs on the thread that finished the
+        call."""
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+    
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+        if not self.done():
+            raise CallTimeoutError("Timed out waiting for the result of a "\
+                "call")
+        return self._exc_info
+    
+    def _set_result(self, result, exc_info=None):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                LOG.exception("Error in callback for %s" % func)
+
+class _Cancel(object):
+    """Cancels the requests made for a call once one of them has answered 
+    it. 
+    
+    The connections the requests are using are taken out of the pool and 
+    their sockets are shut down, so the requests fail at once. 
+    """
+    
+    def __init__(self, pool):
+        self._pool = pool
+        self._event = threading.Event()
+        self._conns = []
+        self._lock = threading.Lock()
+    
+    def isSet(self):
+        """Returns True once the call has been answered."""
+        return self._event.isSet()
+    
+    def set(self):
+        """Cancels the requests still running."""
+        self._lock.acquire()
+        try:
+            self._event.set()
+            conns, self._conns = self._conns, []
+        finally:
+            self._lock.release()
+        for conn in conns:
+            self._pool.detach(conn)
+            _abort_http(conn)
+    
+    def watch(self, conn):
+        """Records a request is using the connection. 
+        
+        :returns: False if the call has already been answered. 
+        """
+        self._lock.acquire()
+        try:
+            if self._event.isSet():
+                return False
+            self._conns.append(conn)
+            return True
+        finally:
+            self._lock.release()
+    
+    def unwatch(self, conn):
+        """Records a request has finished with the connection. 
+        
+        :returns: False if the connection was taken out of the pool. 
+        """
+        self._lock.acquire()
+        try:
+            if conn not in self._conns:
+                return False
+            self._conns.remove(conn)
+            return True
+        finally:
+            self._lock.release()
+
+class _WorkerPool(object):
+    """Fixed number of daemon threads that run queued calls."""
+    
+    def __init__(self, sg, size):
+        """WorkerPool.__init__
+        
+        :param sg: Shotgun client used to start the threads. 
+        
+        :param size: Number of threads, they are started on the first call.
+        """
+        self._sg = sg
+        self._size = max(1, size)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) to run on a worker thread. 
+        
+        :returns: _Future for the result.
+        """
+        future = _Future()
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self._size:
+                self._threads.append(self._sg._start_worker(self._work))
+        finally:
+            self._lock.release()
+        self._queue.put((future, func, args, kwargs))
+        return future
+    
+    def shutdown(self):
+        """Stops the threads once the calls already queued have run."""
+        self._lock.acquire()
+        try:
+            threads, self._threads = self._threads, []
+        finally:
+            self._lock.release()
+        for _ in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join()
+    
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future._set_result(None, sys.exc_info())
+            else:
+                future._set_result(result)
+
+class ThumbnailUrl(object):
+    """URL of an entity's thumbnail that is only looked up when it is used. 
+    
+    Records have one of these in their image field when 
+    config.lazy_thumbnails is set. Converting it to a string or calling 
+    resolve() looks up the url the first time, using it again does not call
+    the server. 
+    """
+    
+    def __init__(self, sg, entity_type, entity_id):
+        self.entity_type = entity_type
+        self.entity_id = entity_id
+        self._sg = sg
+        self._url = None
+    
+    def resolve(self):
+        """Returns the fully qualified url to the thumbnail."""
+        if self._url is None:
+            self._url = self._sg._thumb_url(self.entity_type, self.entity_id)
+        return self._url
+    
+    def __str__(self):
+        return self.resolve()
+    
+    def __repr__(self):
+        return "<ThumbnailUrl %s %s>" % (self.entity_type, self.entity_id)
+    
+    def __eq__(self, other):
+        # not equal to the url string, it would need the same hash
+        if isinstance(other, ThumbnailUrl):
+            return (self.entity_type, self.entity_id) == \
+                (other.entity_type, other.entity_id)
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __hash__(self):
+        return hash((self.entity_type, self.entity_id))
+
+class _ConnectionPool(object):
+    """Thread safe pool of httplib2 Http connections to the server.
+    
+    A Http object is only used by one thread at a time, a thread checks out 
+    a connection for each request and checks it back in afterwards. Up to 
+    config.connection_pool_size connections are created, after that threads 
+    wait for a connection to be checked in. Connections idle for more than
+    config.connection_idle_secs are closed, and sockets the server has 
+    closed are dropped before a connection is reused. 
+    """
+    
+    def __init__(self, factory, config):
+        """ConnectionPool.__init__
+        
+        :param factory: Callable that creates a new Http connection. 
+        
+        :param config: Client _Config with the pool settings.
+        """
+        self.config = config
+        self.size = 0
+        self._factory = factory
+        # list of (Http, time checked in), most recently used last
+        self._idle = []
+        self._cond = threading.Condition()
+    
+    def checkout(self, timeout=None):
+        """Returns an idle connection or a new one if the pool is not full.
+        
+        :param timeout: Optional, most seconds to wait, the lower of this 
+        and config.connection_pool_timeout is used.
+        
+        :raises CallTimeoutError: If no connection is free within the timeout.
+        """
+        pool_timeout = self.config.connection_pool_timeout
+        if pool_timeout is not None and (timeout is None or 
+            pool_timeout < timeout):
+            timeout = pool_timeout
+        deadline = timeout is not None and time.time() + max(timeout, 0.001)
+        
+        self._cond.acquire()
+        try:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    http = self._idle.pop()[0]
+                    break
+                if self.size < max(1, self.config.connection_pool_size):
+                    http = None
+                    self.size += 1
+                    break
+                if deadline and time.time() >= deadline:
+                    raise CallTimeoutError("Timed out waiting for a connection "\
+                        "to the server")
+                self._cond.wait((deadline and deadline - time.time()) or 1.0)
+        finally:
+            self._cond.release()
+        
+        if http is not None:
+            _close_dead_sockets(http)
+            return http
+        try:
+            return self._factory()
+        except Exception:
+            self.discard(None)
+            raise
+    
+    def checkin(self, http):
+        """Returns a connection to the pool for reuse."""
+        self._cond.acquire()
+        try:
+            self._idle.append((http, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+    
+    def discard(self, http):
+        """Closes a checked out connection and removes it from the pool."""
+        _close_http(http)
+        self.detach(http)
+    
+    def detach(self, http):
+        """Removes a checked out connection from the pool without closing 
+        it, whoever is using it must close it."""
+        self._cond.acquire()
+        try:
+            self.size = max(0, self.size - 1)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+    
+    def close(self):
+        """Closes all of the idle connections. Connections that are checked 
+        out are kept when they are checked in."""
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self.size = max(0, self.size - len(idle))
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for http, _ in idle:
+            _close_http(http)
+    
+    def _evict_idle(self):
+        """Closes connections that have been idle for too long, must be 
+        called with the lock held."""
+        max_idle = self.config.connection_idle_secs
+        if max_idle is None:
+            return
+        cutoff = time.time() - max_idle
+        while self._idle and self._idle[0][1] < cutoff:
+            _close_http(self._idle.pop(0)[0])
+            self.size = max(0, self.size - 1)
+
+class _LRUCache(object):
+    """Thread safe cache of values that expire after a time to live. When 
+    the cache is full the least recently used entries are removed.
+    
+    Entries can be given a size, to limit the total size of the cache, and 
+    a tag, to remove all of the entries with that tag at once.
+    
+    A value read before an invalidation is out of date once the 
+    invalidation has happened. Pass set() the generation() from before the 
+    value was read and it is dropped if its tag was invalidated since.
+    """
+    
+    def __init__(self, max_entries=None, ttl=None, max_bytes=None):
+        """LRUCache.__init__
+        
+        :param max_entries: Optional, maximum number of entries to keep, or 
+            a callable returning it so the limit can follow the config. 
+        
+        :param ttl: Optional, default seconds an entry is kept for. 
+        
+        :param max_bytes: Optional, maximum total size of the entries, or 
+            a callable returning it. 
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.num_bytes = 0
+        # key to [value, expires, last used, size, tag, stale until]
+        self._entries = {}
+        self._clock = 0
+        # bumped when any key is invalidated, and when each tag is
+        self._generation = 0
+        self._tag_generations = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key, default=None):
+        """Returns the value for key, or default if it is not in the cache 
+        or has expired."""
+        entry = self.get_entry(key)
+        if entry is None or entry[1]:
+            return default
+        return entry[0]
+    
+    def get_entry(self, key):
+        """Returns a tuple of (value, stale) for key, where stale is True if
+        the value has expired but is within its stale time. Returns None if 
+        key is not in the cache or is past its stale time."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            if entry[5] is not None and entry[5] <= now:
+                self._remove(key)
+                return None
+            self._clock += 1
+            entry[2] = self._clock
+            return (entry[0], entry[1] is not None and entry[1] <= now)
+        finally:
+            self._lock.release()
+    
+    def generation(self, tag=None):
+        """Returns the generation of the entries with the tag, it changes 
+        when they are invalidated."""
+        self._lock.acquire()
+        try:
+            return self._get_generation(tag)
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, ttl=None, size=0, tag=None, stale=0, 
+        generation=None):
+        """Adds or replaces the value for key.
+        
+        :param ttl: Optional, seconds to keep the value for. Defaults to the
+        ttl of the cache. 
+        
+        :param size: Optional, size of the value in bytes. 
+        
+        :param tag: Optional, tag to invalidate the value with. 
+        
+        :param stale: Optional, seconds after the value expires that it is 
+        still returned by get_entry(). 
+        
+        :param generation: Optional, generation() of the tag from before 
+        the value was read. The value is not added if it has changed. 
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = (ttl is not None and time.time() + ttl) or None
+        stale_until = (expires is not None and expires + (stale or 0)) or None
+        
+        self._lock.acquire()
+        try:
+            if generation is not None and \
+                generation != self._get_generation(tag):
+                return
+            self._remove(key)
+            self._clock += 1
+            self._entries[key] = [value, expires, self._clock, size, tag, 
+                stale_until]
+            self.num_bytes += size
+            max_entries, max_bytes = self._limits()
+            if (max_entries and len(self._entries) > max_entries) \
+                or (max_bytes and self.num_bytes > max_bytes):
+                self._evict(max_entries, max_bytes)
+        finally:
+            self._lock.release()
+    
+    def invalidate(self, key=None):
+        """Removes key from the cache, or all keys if key is None."""
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+                self.num_bytes = 0
+            else:
+                self._remove(key)
+        finally:
+            self._lock.release()
+    
+    def invalidate_tag(self, tag):
+        """Removes all of the entries with the tag."""
+        self._lock.acquire()
+        try:
+            self._tag_generations[tag] = self._tag_generations.get(tag, 0) + 1
+            for key, entry in self._entries.items():
+                if entry[4] == tag:
+                    self._remove(key)
+        finally:
+            self._lock.release()
+    
+    def _get_generation(self, tag):
+        """Must be called with the lock held."""
+        return (self._generation, self._tag_generations.get(tag, 0))
+    
+    def _remove(self, key):
+        """Removes key, must be called with the lock held."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[3]
+    
+    def _limits(self):
+        """Returns the current (max_entries, max_bytes)."""
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        if callable(max_entries):
+            max_entries = max_entries()
+        if callable(max_bytes):
+            max_bytes = max_bytes()
+        return max_entries, max_bytes
+    
+    def _evict(self, max_entries, max_bytes):
+        """Removes the least recently used entries until the cache is a 
+        tenth below its limits, must be called with the lock held."""
+        by_use = sorted(self._entries.iteritems(), 
+            key=lambda item: item[1][2])
+        max_entries = max_entries and max(1, max_entries * 9 // 10)
+        max_bytes = max_bytes and max(1, max_bytes * 9 // 10)
+        for key, _ in by_use:
+            if (not max_entries or len(self._entries) <= max_entries) and \
+                (not max_bytes or self.num_bytes <= max_bytes):
+                break
+            self._remove(key)
+
+class _LatencyTracker(object):
+    """Thread safe record of the latest latencies for each key, e.g. rpc 
+    method, to find their percentiles."""
+    
+    MIN_SAMPLES = 20
+    
+    def __init__(self, size=200):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+    
+    def record(self, key, secs):
+        self._lock.acquire()
+        try:
+            samples = self._samples.setdefault(key, [])
+            samples.append(secs)
+            if len(samples) > self.size:
+                del samples[0]
+        finally:
+            self._lock.release()
+    
+    def percentile(self, key, pct):
+        """Returns the pct percentile of the latencies for key, or None if 
+        there are too few of them."""
+        self._lock.acquire()
+        try:
+            samples = sorted(self._samples.get(key) or [])
+        finally:
+            self._lock.release()
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+class _PageSizer(object):
+    """Tunes the number of entities to read per page for each entity type 
+    and set of return fields.
+    
+    The time taken and bytes returned for each page give a cost per entity, 
+    which is used to move the page size toward config.target_page_secs and 
+    config.target_page_bytes. Page sizes are kept between 
+    config.min_records_per_page and config.max_records_per_page.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self._sizes = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, params):
+        return (params["type"], tuple(sorted(params["return_fields"])))
+    
+    def page_size(self, params):
+        """Returns the page size to use for the read parameters."""
+        return self._sizes.get(self._key(params), 
+            min(self.config.records_per_page, 
+                self.config.max_records_per_page))
+    
+    def record(self, params, entity_count, secs, num_bytes):
+        """Records the cost of reading a page and updates the page size for 
+        the read parameters.
+        
+        :param entity_count: Number of entities returned for the page. 
+        
+        :param secs: Seconds taken to read the page. 
+        
+        :param num_bytes: Size of the response body for the page. 
+        """
+        if not entity_count or secs <= 0:
+            return
+        config = self.config
+        
+        target = config.target_page_secs * entity_count / secs
+        if config.target_page_bytes and num_bytes:
+            target = min(target, 
+                float(config.target_page_bytes) * entity_count / num_bytes)
+        
+        self._lock.acquire()
+        try:
+            current = self.page_size(params)
+            # move half way to the target, at most doubling each time
+            size = min((current + target) / 2, current * 2)
+            size = max(config.min_records_per_page, 
+                min(config.max_records_per_page, int(size)))
+            self._sizes[self._key(params)] = size
+        finally:
+            self._lock.release()
+
+class _ReadAhead(object):
+    """Iterator that reads the items from another iterator on a background 
+    thread, keeping up to depth items buffered ahead of the caller.
+    
+    Exceptions raised by the source iterator are raised when the caller 
+    reaches them. The background thread stops once the ReadAhead is closed 
+    or garbage collected. 
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, sg, iterable, depth):
+        """ReadAhead.__init__
+        
+        :param sg: Shotgun client used to start the thread. 
+        
+        :param iterable: Source of the items, it is only used from the 
+        background thread. 
+        
+        :param depth: Maximum number of items to buffer.
+        """
+        self._queue = queue = Queue.Queue(depth)
+        # shared with the thread, do not hold a reference to self there
+        self._stopped = stopped = []
+        self._finished = False
+        done = self._DONE
+        
+        def _put(entry):
+            while not stopped:
+                try:
+                    queue.put(entry, True, 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        
+        def _fill():
+            try:
+                for item in iterable:
+                    if not _put((item, None)):
+                        return
+            except Exception:
+                _put((None, sys.exc_info()))
+            else:
+                _put((done, None))
+        
+        sg._start_worker(_fill)
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        
+        item, exc_info = self._queue.get()
+        if exc_info:
+            self.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is self._DONE:
+            self.close()
+            raise StopIteration
+        return item
+    
+    def close(self):
+        """Stops the background thread."""
+        self._finished = True
+        self._stopped.append(True)
+    
+    def __del__(self):
+        self.close()
+
+def _write_file_atomic(path, data):
+    """Writes data to the file at path, creating its directory if needed. 
+    
+    The data is written to a temp file that is renamed to path, so readers
+    in other processes never see part of the file. 
+    
+    :raises IOError, OSError: If the file could not be written.
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            # another process may have just made it
+            if not os.path.isdir(dir_name):
+                raise
+    
+    tmp_path = "%s.%s.%s.tmp" % (path, os.getpid(), 
+        threading.currentThread().getName())
+    try:
+        f = open(tmp_path, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        if os.path.exists(path) and sys.platform == "win32":
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _close_http(http):
+    """Closes all of the sockets held by a httplib2 Http object."""
+    if http is None:
+        return
+    
+    for conn in http.connections.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    http.connections.clear()
+    return
+
+def _close_dead_sockets(http):
+    """Closes any sockets held by a httplib2 Http object that the server has 
+    closed, httplib2 reconnects them when they are next used.
+    
+    An idle keep-alive socket has nothing to read, if it is readable the 
+    server has closed it or sent data that was not asked for. 
+    """
+    for conn in http.connections.values():
+        sock = getattr(conn, "sock", None)
+        if sock is None:
+            continue
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except Exception:
+            readable = True
+        if readable:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+def _abort_http(http):
+    """Shuts down the sockets of a httplib2 Http object that is in use on 
+    another thread, so its request fails rather than reconnecting."""
+    for conn in http.connections.values():
+        conn.connect = _refuse_connect
+        sock = getattr(conn, "sock", None)
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+def _refuse_connect():
+    raise socket.error("Request was cancelled")
+
+# Helpers from the previous API, left as is. 
+
+# Based on http://code.activestate.com/recipes/146306/
+class FormPostHandler(urllib2.BaseHandler):
+    """
+    Handler for multipart form data
+    """
+    handler_order = urllib2.HTTPHandler.handler_order - 10 # needs to run first
+    
+    def http_request(self, request):
+        data = request.get_data()
+        if data is not None and not isinstance(data, basestring):
+            files = []
+            params = []
+            for key, value in data.items():
+                if isinstance(value, file):
+                    files.append((key, value))
+                else:
+                    params.append((key, value))
+            if not files:
+                data = urllib.urlencode(params, True) # sequencing on
+            else:
+                boundary, data = self.encode(params, files)
+                content_type = 'multipart/form-data; boundary=%s' % boundary
+                request.add_unredirected_header('Content-Type', content_type)
+            request.add_data(data)
+        return request
+    
+    def encode(self, params, files, boundary=None, buffer=None):
+        if boundary is None:
+            boundary = mimetools.choose_boundary()
+        if buffer is None:
+            buffer = cStringIO.StringIO()
+        for (key, value) in params:
+            buffer.write('--%s\r\n' % boundary)
+            buffer.write('Content-Disposition: form-data; name="%s"' % key)
+            buffer.write('\r\n\r\n%s\r\n' % value)
+        for (key, fd) in files:
+            filename = fd.name.split('/')[-1]
+            content_type = mimetypes.guess_type(filename)[0]
+            content_type = content_type or 'application/octet-stream'
+            file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
+            buffer.write('--%s\r\n' % boundary)
+            c_dis = 'Content-Disposition: form-data; name="%s"; filename="%s"%s'
+            content_disposition = c_dis % (key, filename, '\r\n')
+            buffer.write(content_disposition)
+            buffer.write('Content-Type: %s\r\n' % content_type)
+            buffer.write('Content-Length: %s\r\n' % file_size)
+            fd.seek(0)
+            buffer.write('\r\n%s\r\n' % fd.read())
+        buffer.write('--%s--\r\n\r\n' % boundary)
+        buffer = buffer.getvalue()
+        return boundary, buffer
+    
+    def https_request(self, request):
+        return self.http_request(request)
+
+
+def _add_filter_condition(filters, condition):
+    '''_add_filter_condition returns a copy of the translated filters that 
+    also requires the filter condition, of the form [path, relation, value],
+    to match.'''
+    new_condition = {"path":condition[0], "relation":condition[1], 
+                     "values":condition[2:]}
+    if filters.get("logical_operator") == "and":
+        conditions = list(filters.get("conditions") or [])
+    else:
+        conditions = [filters]
+    conditions.append(new_condition)
+    return {"logical_operator":"and", "conditions":conditions}
+
+# rpc methods that do not change data on the server
+_READ_METHODS = ("info", "read", "summarize", "schema_read", 
+    "schema_entity_read", "schema_field_read")
+
+# rpc methods whose requests may be sent twice to cut their latency
+_HEDGE_METHODS = ("read", "summarize", "schema_read", "schema_entity_read", 
+    "schema_field_read")
+
+def _translate_filters(filters, filter_operator):
+    '''_translate_filters translates filters params into data structure
+    expected by rpc call.'''
+    new_filters = {}
+        
+    if not filter_operator or filter_operator == "all":
+        new_filters["logical_operator"] = "and"
+    else:
         new_filters["logical_operator"] = "or"
     conditions = [{"path":f[0], "relation":f[1], "values":f[2:]} 
                                                 for f in filters]
     new_filters["conditions"] = conditions
     return new_filters
+
+def _match_filters(filters, record, now=None):
+    '''_match_filters returns True if the record matches the filters, using 
+    the same rules as the server. 
+    
+    :param filters: filters in the structure built by _translate_filters(),
+    conditions may also be nested filters. 
+    
+    :param record: entity dict as returned by find(). Linked fields, e.g. 
+    'entity.Shot.code', are read from the record if they were returned, 
+    otherwise from the linked entity dict. 
+    
+    :param now: Optional, local time the date relations are relative to. 
+    Defaults to now.
+    
+    :raises ShotgunError: If a relation is not supported or a field is not 
+    in the record.
+    '''
+    if now is None:
+        now = datetime.datetime.now()
+    match_any = filters.get("logical_operator") == "or"
+    for condition in filters.get("conditions") or []:
+        if "conditions" in condition:
+            matched = _match_filters(condition, record, now)
+        else:
+            matched = _match_condition(condition, record, now)
+        if matched == match_any:
+            return matched
+    return not match_any
+
+def _match_condition(condition, record, now):
+    relation = condition["relation"]
+    match = _FILTER_RELATIONS.get(relation)
+    if match is None:
+        raise ShotgunError("Filter relation '%s' is not supported" % 
+            relation)
+    value = _filter_value(_record_path(record, condition["path"]))
+    values = [_filter_value(v) for v in condition["values"]]
+    if relation in ("in", "not_in") and len(values) == 1 and \
+        isinstance(values[0], (list, tuple)):
+        values = [_filter_value(v) for v in values[0]]
+    
+    if isinstance(value, list):
+        # multi entity fields match if any of the entities match
+        if relation in ("is", "in") or relation.startswith("type_is") or \
+            relation.startswith("name_"):
+            if relation == "is" and values[0] is None:
+                return not value
+            for item in value:
+                if match(item, values, now):
+                    return True
+            return False
+        if relation in ("is_not", "not_in"):
+            if relation == "is_not" and values[0] is None:
+                return bool(value)
+            positive = {"is_not" : "is", "not_in" : "in"}[relation]
+            for item in value:
+                if _FILTER_RELATIONS[positive](item, values, now):
+                    return False
+            return True
+        raise ShotgunError("Filter relation '%s' is not supported for "\
+            "multi entity field %s" % (relation, condition["path"]))
+    return match(value, values, now)
+
+def _record_path(record, path):
+    """Value of the field or linked field path in the record."""
+    if path in record:
+        return record[path]
+    parts = path.split(".")
+    if len(parts) >= 3:
+        linked = _record_path(record, parts[0])
+        if not linked:
+            return None
+        if isinstance(linked, dict):
+            if linked.get("type") != parts[1]:
+                return None
+            return _record_path(linked, ".".join(parts[2:]))
+    raise ShotgunError("Field %s is not in the record" % path)
+
+def _filter_value(value):
+    """Normalises a record or filter value so they can be compared. Entities 
+    become (type, id), datetimes naive local times, dates and date strings
+    dates."""
+    if isinstance(value, dict) and "type" in value and "id" in value:
+        return _FilterEntity(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(SG_TIMEZONE.local).replace(tzinfo=None)
+        return value
+    if isinstance(value, basestring) and len(value) == 10 and \
+        Shotgun._DATE_PATTERN.match(value):
+        return datetime.date(*time.strptime(value, "%Y-%m-%d")[:3])
+    if isinstance(value, list):
+        return [_filter_value(v) for v in value]
+    return value
+
+class _FilterEntity(object):
+    """Linked entity in a filter, equal to other entities with the same type
+    and id."""
+    
+    def __init__(self, entity):
+        self.type = entity["type"]
+        self.id = entity["id"]
+        self.name = entity.get("name")
+    
+    def __eq__(self, other):
+        return isinstance(other, _FilterEntity) and \
+            (self.type, self.id) == (other.type, other.id)
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        return hash((self.type, self.id))
+
+def _compare(value, other):
+    """Compares record and filter values, dates compare with datetimes at 
+    midnight. Returns None if they cannot be compared."""
+    if value is None or other is None:
+        return None
+    value, other = _date_time(value), _date_time(other)
+    try:
+        return cmp(value, other)
+    except TypeError:
+        return None
+
+def _date_time(value):
+    if isinstance(value, datetime.date) and \
+        not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+def _text(value):
+    if isinstance(value, _FilterEntity):
+        value = value.name
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return unicode(value).lower()
+
+def _match_text(test):
+    def _match(value, values, now):
+        value, other = _text(value), _text(values[0])
+        return value is not None and other is not None and test(value, other)
+    return _match
+
+def _match_name(test):
+    def _match(value, values, now):
+        return isinstance(value, _FilterEntity) and \
+            test(_text(value.name) or u"", _text(values[0]) or u"")
+    return _match
+
+def _shift_time(value, count, unit):
+    """Moves the datetime by count units, e.g. (3, 'DAY')."""
+    unit = unit.upper()
+    if unit in ("MONTH", "YEAR"):
+        if unit == "YEAR":
+            count *= 12
+        months = value.month - 1 + count
+        year, month = value.year + months // 12, months % 12 + 1
+        day = min(value.day, calendar.monthrange(year, month)[1])
+        return value.replace(year=year, month=month, day=day)
+    units = {"HOUR" : 3600, "DAY" : 86400, "WEEK" : 7 * 86400}
+    if unit not in units:
+        raise ShotgunError("Date unit '%s' is not supported" % unit)
+    return value + datetime.timedelta(seconds=count * units[unit])
+
+def _match_in_last(value, values, now):
+    start = _shift_time(now, -int(values[0]), values[1])
+    return _compare(value, start) >= 0 and _compare(value, now) <= 0
+
+def _match_in_next(value, values, now):
+    end = _shift_time(now, int(values[0]), values[1])
+    return _compare(value, now) >= 0 and _compare(value, end) <= 0
+
+def _calendar_period(unit):
+    """Returns a function for the in_calendar_<unit> relations, which match
+    dates in the current period moved by the filter value."""
+    def _period(value, offset):
+        if unit == "day":
+            return (value + datetime.timedelta(days=offset)).toordinal()
+        if unit == "week":
+            monday = value - datetime.timedelta(days=value.weekday())
+            return (monday + datetime.timedelta(weeks=offset)).toordinal()
+        if unit == "month":
+            return value.year * 12 + value.month - 1 + offset
+        return value.year + offset
+    
+    def _match(value, values, now):
+        if not isinstance(value, datetime.date):
+            return False
+        offset = int((values and values[0]) or 0)
+        return _period(_date_time(value).date(), 0) == \
+            _period(now.date(), offset)
+    return _match
+
+def _negate(match):
+    def _match(value, values, now):
+        return not match(value, values, now)
+    return _match
+
+_FILTER_RELATIONS = {
+    "is" : lambda v, vs, now: v == vs[0],
+    "is_not" : lambda v, vs, now: v != vs[0],
+    "less_than" : lambda v, vs, now: _compare(v, vs[0]) == -1,
+    "greater_than" : lambda v, vs, now: _compare(v, vs[0]) == 1,
+    "between" : lambda v, vs, now: _compare(v, vs[0]) in (0, 1) and 
+        _compare(v, vs[1]) in (-1, 0),
+    "in" : lambda v, vs, now: v in vs,
+    "not_in" : lambda v, vs, now: v not in vs,
+    "contains" : _match_text(lambda v, o: o in v),
+    "starts_with" : _match_text(lambda v, o: v.startswith(o)),
+    "ends_with" : _match_text(lambda v, o: v.endswith(o)),
+    "type_is" : lambda v, vs, now: isinstance(v, _FilterEntity) and 
+        v.type == vs[0],
+    "name_is" : _match_name(lambda v, o: v == o),
+    "name_contains" : _match_name(lambda v, o: o in v),
+    "name_starts_with" : _match_name(lambda v, o: v.startswith(o)),
+    "name_ends_with" : _match_name(lambda v, o: v.endswith(o)),
+    "in_last" : _match_in_last,
+    "in_next" : _match_in_next,
+    "in_calendar_day" : _calendar_period("day"),
+    "in_calendar_week" : _calendar_period("week"),
+    "in_calendar_month" : _calendar_period("month"),
+    "in_calendar_year" : _calendar_period("year"),
+}
+_FILTER_RELATIONS.update({
+    "not_between" : _negate(_FILTER_RELATIONS["between"]),
+    "not_contains" : _negate(_FILTER_RELATIONS["contains"]),
+    "type_is_not" : _negate(_FILTER_RELATIONS["type_is"]),
+    "name_not_contains" : _negate(_FILTER_RELATIONS["name_contains"]),
+    "not_in_last" : _negate(_match_in_last),
+    "not_in_next" : _negate(_match_in_next),
+})
@@ -81,7 +81,6 @@ class MockTestBase(TestBase):
         #The Http objects connection property is a dict of connections 
         #it is holding
         self.mock_conn.connections = dict()
-        self.sg._connection = self.mock_conn
         self.sg._get_connection = mock.Mock(return_value=self.mock_conn)
         
         #create the server caps directly to say we have the correct version
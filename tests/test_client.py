@@ -4,13 +4,19 @@ need a live server to run against."""
 
 import base64
 import datetime
+import errno
+import os
 import re
+import shutil
+import socket
+import tempfile
 try:
     import simplejson as json
 except ImportError:
     import json as json
 import platform
 import sys
+import threading
 import time
 import unittest
 import mock
@@ -154,8 +160,10 @@ class TestShotgunClient(base.MockTestBase):
         #The mock created an existing mock connection, 
         self.sg.connect()
         self.assertEqual(0, self.mock_conn.request.call_count)
+        self.assertEqual([self.mock_conn], 
+            [http for http, _ in self.sg._connection_pool._idle])
         self.sg.close()
-        self.assertEqual(None, self.sg._connection)
+        self.assertEqual([], self.sg._connection_pool._idle)
         
 
     def test_network_retry(self):
@@ -167,6 +175,394 @@ class TestShotgunClient(base.MockTestBase):
             self.sg.config.max_rpc_attempts ==self.sg._http_request.call_count, 
             "Call is repeated")
 
+    def test_retry_policy(self):
+        """Failed requests are repeated if they can be"""
+        self.sg.config.retry_policy = api.RetryPolicy(backoff_secs=0)
+        self._mock_http({"results" : {"entities" : [], 
+            "paging_info" : {"entity_count" : 0}}})
+        response = self.sg._http_request.return_value
+        unavailable = ((503, "Service Unavailable"), {}, "")
+        def _responses(*responses):
+            responses = list(responses)
+            def _request(*args):
+                result = responses.pop(0)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            return _request
+        
+        self.sg._http_request.side_effect = _responses(unavailable, response)
+        self.assertEqual([], self.sg.find("Shot", []))
+        self.assertEqual(2, self.sg._http_request.call_count)
+        
+        self.sg._http_request.reset_mock()
+        self.sg._http_request.side_effect = _responses(unavailable, response)
+        self.assertRaises(api.ProtocolError, self.sg.create, "Shot", {})
+        self.assertEqual(1, self.sg._http_request.call_count, 
+            "create is not repeated if the server may have run it")
+        
+        self.sg._http_request.reset_mock()
+        self.sg._http_request.side_effect = _responses(
+            socket.error(errno.ECONNREFUSED, "Connection refused"), response)
+        self.sg.create("Shot", {})
+        self.assertEqual(2, self.sg._http_request.call_count, 
+            "create is repeated if it was not sent")
+        
+        self.sg._http_request.reset_mock()
+        self.sg._http_request.side_effect = ValueError
+        self.assertRaises(ValueError, self.sg.find, "Shot", [])
+        self.assertEqual(1, self.sg._http_request.call_count)
+        
+        self.sg.config.retry_policy = api.RetryPolicy(backoff_secs=0, 
+            budget=1, budget_ratio=0)
+        self.sg._http_request.reset_mock()
+        self.sg._http_request.side_effect = socket.timeout
+        self.assertRaises(socket.timeout, self.sg.find, "Shot", [])
+        self.assertEqual(2, self.sg._http_request.call_count, 
+            "retries stop when the budget is spent")
+        
+        policy = api.RetryPolicy(backoff_secs=1, max_backoff_secs=3)
+        for attempt, limit in [(1, 1), (2, 2), (3, 3), (10, 3)]:
+            backoff = policy.backoff(attempt)
+            self.assertTrue(0 <= backoff <= limit)
+
+    def test_circuit_breaker(self):
+        """Calls fail at once while the server keeps failing"""
+        state_dir = tempfile.mkdtemp()
+        state_path = os.path.join(state_dir, "circuit")
+        try:
+            breaker = api.CircuitBreaker(failure_threshold=2, reset_secs=60,
+                state_path=state_path)
+            self.sg.config.circuit_breaker = breaker
+            self.sg.config.retry_policy = api.RetryPolicy(backoff_secs=0)
+            response = self.sg._http_request.return_value
+            self.sg._http_request.side_effect = socket.timeout
+            
+            self.assertRaises(api.CircuitOpenError, self.sg.info)
+            self.assertEqual(2, self.sg._http_request.call_count)
+            self.assertRaises(api.CircuitOpenError, self.sg.info)
+            self.assertEqual(2, self.sg._http_request.call_count)
+            other = api.CircuitBreaker(state_path=state_path)
+            self.assertRaises(api.CircuitOpenError, other.before_request)
+            
+            # one request tests the server once the circuit has reset
+            breaker.changed_at -= 60
+            breaker.before_request()
+            self.assertEqual(breaker.HALF_OPEN, breaker.state)
+            self.assertRaises(api.CircuitOpenError, self.sg.info)
+            breaker.record_failure()
+            self.assertEqual(breaker.OPEN, breaker.state)
+            
+            breaker.changed_at -= 60
+            self.sg._http_request.side_effect = None
+            self.sg._http_request.return_value = response
+            self.sg.info()
+            self.assertEqual(breaker.CLOSED, breaker.state)
+            other.before_request()
+            self.assertEqual(other.CLOSED, other.state)
+            
+            # changes are seen when the file time is not changed
+            os.utime(state_path, (1000000000, 1000000000))
+            other.before_request()
+            breaker.record_failure()
+            breaker.record_failure()
+            os.utime(state_path, (1000000000, 1000000000))
+            self.assertRaises(api.CircuitOpenError, other.before_request)
+            
+            # requests that get no response do not close the circuit
+            breaker.changed_at -= 60
+            self.sg._http_request.side_effect = api.CallTimeoutError("BANG")
+            self.assertRaises(api.CallTimeoutError, self.sg.info)
+            self.assertEqual(breaker.OPEN, breaker.state)
+            limiter = api.RateLimiter(max_in_flight=1)
+            limiter.acquire()
+            self.sg.config.rate_limiter = limiter
+            self.assertRaises(api.CallTimeoutError, self.sg.info, timeout=0.01)
+            self.assertEqual(breaker.OPEN, breaker.state)
+            self.assertTrue(breaker.before_request(), 
+                "the next request tests the server")
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_rate_limiter(self):
+        """Requests are limited by rate and number in flight"""
+        limiter = api.RateLimiter(rate=100, burst=1)
+        start = time.time()
+        for i in range(5):
+            limiter.acquire()
+            limiter.release(0)
+        self.assertTrue(time.time() - start >= 0.03)
+        
+        limiter = api.RateLimiter(max_in_flight=1)
+        limiter.acquire()
+        acquired = threading.Event()
+        def _acquire():
+            limiter.acquire()
+            acquired.set()
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        acquired.wait(0.05)
+        self.assertFalse(acquired.isSet())
+        limiter.release(0)
+        thread.join()
+        self.assertTrue(acquired.isSet())
+
+    def test_rate_limiter_adaptive(self):
+        """Adaptive limits drop when the server is overloaded"""
+        limiter = api.RateLimiter(rate=1000, max_in_flight=8, adaptive=True, 
+            target_latency_secs=1)
+        limiter.acquire()
+        limiter.release(0.1, status=429)
+        self.assertEqual((500, 4), (limiter.rate, limiter.limit))
+        limiter.acquire()
+        limiter.release(0.1, status=503)
+        self.assertEqual(4, limiter.limit, "lowered once each round trip")
+        for i in range(4):
+            limiter.acquire()
+            limiter.release(0.1, status=200)
+        self.assertTrue(4.9 < limiter.limit < 5.1)
+        limiter._decreased_at = 0
+        limiter.acquire()
+        limiter.release(2, status=200)
+        self.assertTrue(limiter.limit < 3, "slow requests lower the limit")
+        
+        self.sg.config.rate_limiter = api.RateLimiter(max_in_flight=2, 
+            adaptive=True)
+        self.sg.config.retry_policy = api.RetryPolicy(backoff_secs=0)
+        self._mock_http("", status=(503, "Service Unavailable"))
+        self.assertRaises(api.ProtocolError, self.sg.find, "Shot", [])
+        self.assertEqual(1, self.sg.config.rate_limiter.limit)
+        self.assertEqual(0, self.sg.config.rate_limiter.in_flight)
+        self.sg._http_request.side_effect = KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, self.sg.find, "Shot", [])
+        self.assertEqual(0, self.sg.config.rate_limiter.in_flight, 
+            "slot is freed when the request is interrupted")
+        
+        # the lowest latency does not rise above the latency seen
+        limiter = api.RateLimiter(max_in_flight=8, adaptive=True)
+        for latency in [0.1] + [0.15] * 200:
+            limiter.acquire()
+            limiter.release(latency, status=200)
+        self.assertTrue(limiter._min_latency <= 0.15)
+
+    def test_call_timeout(self):
+        """Calls with a timeout give up once they cannot finish in time"""
+        self._mock_http({"results" : {"entities" : [], 
+            "paging_info" : {"entity_count" : 0}}})
+        response = self.sg._http_request.return_value
+        time_left = []
+        def _request(*args):
+            time_left.append(self.sg._time_left())
+            return response
+        self.sg._http_request.side_effect = _request
+        
+        self.sg.find_one("Shot", [], timeout=5)
+        self.assertTrue(0 < time_left[0] <= 5)
+        self.assertEqual(None, self.sg._time_left())
+        self.sg.find_one("Shot", [])
+        self.assertEqual(None, time_left[1])
+        
+        self.assertRaises(api.CallTimeoutError, self.sg.find, "Shot", [], 
+            timeout=0)
+        self.assertEqual(2, self.sg._http_request.call_count)
+        
+        self.sg.config.retry_policy.backoff = lambda attempt: 5
+        self.sg._http_request.side_effect = socket.timeout
+        start = time.time()
+        self.assertRaises(socket.timeout, self.sg.find, "Shot", [], 
+            timeout=1)
+        self.assertEqual(3, self.sg._http_request.call_count, 
+            "not repeated when the wait passes the timeout")
+        self.assertTrue(time.time() - start < 1)
+        
+        self.assertEqual("find", api.Shotgun.find.__name__)
+        self.assertEqual("shotgun_api3.shotgun", api.Shotgun.find.__module__)
+        self.assertTrue(":param timeout:" in api.Shotgun.find.__doc__)
+        
+        limiter = api.RateLimiter(max_in_flight=1)
+        limiter.acquire()
+        self.assertFalse(limiter.acquire(0.01))
+        self.assertEqual(1, limiter.in_flight)
+
+    def test_call_timeout_workers(self):
+        """Requests made on worker threads share the call's timeout"""
+        pages = {}
+        def _request(verb, path, body, headers):
+            page = json.loads(body)["params"][1]["paging"]["current_page"]
+            pages[page] = self.sg._time_left()
+            return ((200, "OK"), {}, json.dumps({"results" : {
+                "entities" : [{"type" : "Shot", "id" : page}],
+                "paging_info" : {"entity_count" : 4}}}))
+        self.sg._http_request.side_effect = _request
+        self.sg.config.records_per_page = 1
+        
+        self.sg.find("Shot", [], max_parallel_pages=3, timeout=5)
+        self.assertEqual([1, 2, 3, 4], sorted(pages))
+        for page, time_left in pages.items():
+            self.assertTrue(time_left is not None and 0 < time_left <= 5, 
+                "page %s has the timeout" % page)
+        self.sg.find("Shot", [], max_parallel_pages=3)
+        self.assertEqual([None] * 4, pages.values())
+        
+        pages.clear()
+        records = self.sg.find_iter("Shot", [], prefetch_pages=2, timeout=5)
+        self.assertEqual(None, self.sg._time_left())
+        self.assertEqual(4, len(list(records)))
+        self.assertTrue(None not in pages.values(), "pages have the timeout")
+        
+        pages.clear()
+        self.sg.find_many([("Shot", [])] * 2, max_workers=2, 
+            deadline=time.time() + 5)
+        self.assertTrue(None not in pages.values(), "queries have the timeout")
+        results = self.sg.find_many([("Shot", [])], 
+            deadline=time.time() - 1)
+        self.assertTrue(isinstance(results[0], api.CallTimeoutError))
+
+    def test_hedged_reads(self):
+        """Slow reads are sent again and the first response is used"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        response = self.sg._http_request.return_value
+        self.assertEqual(None, self.sg._latencies.percentile("read", 95))
+        for i in range(20):
+            self.sg._latencies.record("read", 0.01 * (i + 1))
+        self.assertEqual(0.2, self.sg._latencies.percentile("read", 95))
+        self.assertEqual(0.11, self.sg._latencies.percentile("read", 50))
+        
+        self.sg.config.hedge_reads = True
+        self.sg.config.hedge_percentile = 0
+        release = threading.Event()
+        requests = []
+        def _request(*args):
+            requests.append(args)
+            if len(requests) == 1:
+                # the first request is a straggler
+                release.wait()
+            return response
+        self.sg._http_request.side_effect = _request
+        try:
+            self.assertEqual([{"type" : "Shot", "id" : 1}], 
+                self.sg.find("Shot", []))
+            self.assertEqual(2, len(requests))
+            self.assertEqual(requests[0], requests[1])
+        finally:
+            release.set()
+        
+        self.sg.create("Shot", {})
+        self.assertEqual(3, len(requests), "writes are not hedged")
+        
+        # only the first request adds to the retry budget
+        policy = self.sg.config.retry_policy
+        policy.record_request = mock.Mock()
+        release.clear()
+        del requests[:]
+        try:
+            self.sg.find("Shot", [])
+        finally:
+            release.set()
+        self.assertEqual(1, policy.record_request.call_count)
+        
+        # a failed request waits for the other to answer
+        release.clear()
+        del requests[:]
+        def _request(*args):
+            requests.append(args)
+            if len(requests) == 1:
+                release.wait()
+                return response
+            release.set()
+            raise ValueError("Go BANG")
+        self.sg._http_request.side_effect = _request
+        self.assertEqual([{"type" : "Shot", "id" : 1}], 
+            self.sg.find("Shot", []))
+        
+        # an error is raised once both have failed
+        release.clear()
+        del requests[:]
+        def _request(*args):
+            requests.append(args)
+            if len(requests) == 1:
+                release.wait()
+            else:
+                release.set()
+            raise ValueError("Go BANG %s" % len(requests))
+        self.sg._http_request.side_effect = _request
+        self.assertRaises(ValueError, self.sg.find, "Shot", [])
+        
+        # stragglers do not stop other reads, or wait past the timeout
+        release.clear()
+        del requests[:]
+        def _request(*args):
+            requests.append(args)
+            release.wait()
+            return response
+        self.sg._http_request.side_effect = _request
+        self.sg._hedge_workers = api.shotgun._WorkerPool(self.sg, 1)
+        try:
+            self.assertRaises(api.CallTimeoutError, self.sg.find, "Shot", [],
+                timeout=0.2)
+            self.assertRaises(api.CallTimeoutError, self.sg.find, "Shot", [],
+                timeout=0.2)
+            self.assertEqual(3, len(requests), "hedge is not queued")
+        finally:
+            release.set()
+
+    def test_hedge_cancel(self):
+        """Cancelling a hedged request shuts down its connection"""
+        pool = api.shotgun._ConnectionPool(mock.Mock, 
+            api.shotgun._Config())
+        http = pool.checkout()
+        conn = mock.Mock()
+        http.connections = {"https:foo" : conn}
+        cancel = api.shotgun._Cancel(pool)
+        self.assertTrue(cancel.watch(http))
+        self.assertEqual(1, pool.size)
+        
+        cancel.set()
+        self.assertEqual(0, pool.size)
+        conn.sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        self.assertRaises(socket.error, conn.connect)
+        self.assertFalse(cancel.watch(pool.checkout()))
+        self.assertFalse(cancel.unwatch(http))
+
+    def test_hedged_reads_connections(self):
+        """The connection used by the slower request of a hedged read is 
+        taken out of the pool"""
+        del self.sg._http_request
+        del self.sg._get_connection
+        body = json.dumps({"results" : {"entities" : [], 
+            "paging_info" : {"entity_count" : 0}}})
+        release = threading.Event()
+        requests = []
+        class _Response(dict):
+            status = 200
+            reason = "OK"
+        class _Http(object):
+            def __init__(self):
+                self.connections = {}
+            def request(self, *args, **kwargs):
+                requests.append(self)
+                if len(requests) == 1:
+                    release.wait()
+                return _Response(), body
+        pool = self.sg._connection_pool
+        pool._factory = _Http
+        for i in range(20):
+            self.sg._latencies.record("read", 0.01)
+        self.sg.config.hedge_reads = True
+        
+        try:
+            self.assertEqual([], self.sg.find("Shot", []))
+            self.assertEqual(2, len(requests))
+            self.assertEqual(1, pool.size, "slow connection is not counted")
+            self.assertEqual([requests[1]], [http for http, _ in pool._idle])
+        finally:
+            release.set()
+        self.sg._hedge_workers.shutdown()
+        self.assertEqual(1, pool.size)
+        self.assertEqual([requests[1]], [http for http, _ in pool._idle], 
+            "slow connection is not returned to the pool")
+
     def test_http_error(self):
         """HTTP error raised and not retried."""
         
@@ -224,6 +620,352 @@ class TestShotgunClient(base.MockTestBase):
         expected = "rpc response with list result, first item"
         self.assertEqual(d["results"][0], rv, expected )
         
+    def test_result_cache(self):
+        """Read results are cached until they expire or are invalidated"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        self.sg.config.cache_results = True
+        
+        expected = [{"type" : "Shot", "id" : 1}]
+        self.assertEqual(expected, self.sg.find("Shot", [["id", "is", 1]]))
+        result = self.sg.find("Shot", [["id", "is", 1]])
+        self.assertEqual(expected, result)
+        self.assertEqual(1, self.sg._http_request.call_count)
+        result[0]["id"] = 2
+        self.assertEqual(expected, self.sg.find("Shot", [["id", "is", 1]]),
+            "cached results are not shared with callers")
+        
+        self.sg.find("Shot", [["id", "is", 2]])
+        self.assertEqual(2, self.sg._http_request.call_count)
+        
+        self.sg.invalidate_cache("Asset")
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.assertEqual(2, self.sg._http_request.call_count)
+        self.sg.invalidate_cache("Shot")
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.assertEqual(3, self.sg._http_request.call_count)
+        
+        self.sg.config.cache_ttls["Shot"] = -1
+        self.sg.invalidate_cache()
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.assertEqual(5, self.sg._http_request.call_count, 
+            "expired results are read again")
+
+    def test_result_cache_limits(self):
+        """Cache limits changed on the config apply to the client"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        self.sg.config.cache_results = True
+        self.sg.config.cache_max_entries = 1
+        
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.sg.find("Shot", [["id", "is", 2]])
+        self.sg.find("Shot", [["id", "is", 1]])
+        self.assertEqual(3, self.sg._http_request.call_count)
+        self.assertEqual(1, len(self.sg._result_cache))
+
+    def test_result_cache_stale(self):
+        """Stale results are returned while they are read again"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        self.sg.config.cache_results = True
+        self.sg.config.cache_ttls["Shot"] = -1
+        self.sg.config.cache_stale_ttls["Shot"] = 60
+        refreshes = []
+        self.sg._start_worker = mock.Mock(side_effect=refreshes.append)
+        
+        self.assertEqual(1, self.sg.find_one("Shot", [])["id"])
+        self.sg._http_request.return_value = ((200, "OK"), {}, 
+            json.dumps({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 2}], "paging_info" : {"entity_count" : 1}}}))
+        self.assertEqual(1, self.sg.find_one("Shot", [])["id"])
+        self.assertEqual(1, self.sg.find_one("Shot", [])["id"])
+        self.assertEqual(1, len(refreshes), "one refresh for each result")
+        self.assertEqual(1, self.sg._http_request.call_count)
+        
+        refreshes.pop()()
+        self.assertEqual(2, self.sg._http_request.call_count)
+        self.assertEqual(2, self.sg.find_one("Shot", [])["id"])
+        
+        self.sg.config.cache_stale_ttls["Shot"] = -1
+        self.sg.invalidate_cache()
+        self.sg.find_one("Shot", [])
+        self.sg.find_one("Shot", [])
+        self.assertEqual(4, self.sg._http_request.call_count, 
+            "results past their stale time are read again")
+
+    def test_cache_invalidated_during_read(self):
+        """Results read while the cache is invalidated are not cached"""
+        self._mock_http({"results" : {"entities" : [], 
+            "paging_info" : {"entity_count" : 0}}})
+        response = self.sg._http_request.return_value
+        self.sg.config.cache_results = True
+        self.sg.config.cache_misses_secs = 60
+        def _request(*args):
+            # another thread changes a Shot while the read is in flight
+            self.sg.invalidate_cache("Shot")
+            return response
+        self.sg._http_request.side_effect = _request
+        
+        self.sg.find_one("Shot", [])
+        self.sg._http_request.side_effect = None
+        self.sg.find_one("Shot", [])
+        self.assertEqual(2, self.sg._http_request.call_count)
+        self.sg.find_one("Shot", [])
+        self.assertEqual(2, self.sg._http_request.call_count)
+        
+        cache = api.shotgun._LRUCache()
+        generation = cache.generation("Shot")
+        cache.invalidate_tag("Asset")
+        cache.set("asset", "value", tag="Asset", 
+            generation=cache.generation("Asset"))
+        cache.set("shot", "value", tag="Shot", generation=generation)
+        self.assertEqual("value", cache.get("shot"))
+        self.assertEqual("value", cache.get("asset"))
+        cache.invalidate("asset")
+        cache.set("shot", "new value", tag="Shot", generation=generation)
+        self.assertEqual("value", cache.get("shot"))
+
+    def test_coalesce_reads(self):
+        """Identical reads made at the same time share one request"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Project", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        response = self.sg._http_request.return_value
+        release = threading.Event()
+        def _request(*args):
+            release.wait()
+            return response
+        self.sg._http_request.side_effect = _request
+        
+        # let the request finish once every thread has checked for it
+        num_threads = 5
+        class _InFlight(dict):
+            checked = 0
+            def get(self, key):
+                self.checked += 1
+                if self.checked == num_threads:
+                    release.set()
+                return dict.get(self, key)
+        self.sg._in_flight = _InFlight()
+        
+        results = []
+        def _find():
+            results.append(self.sg.find_one("Project", 
+                [["name", "is", "Big Buck"]]))
+        threads = [threading.Thread(target=_find) 
+            for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([{"type" : "Project", "id" : 1}] * num_threads, 
+            results)
+        self.assertEqual(1, self.sg._http_request.call_count)
+        self.assertEqual(0, len(self.sg._in_flight))
+        results[0]["id"] = 2
+        self.assertEqual(1, results[1]["id"], "results are not shared")
+        
+        self.sg.config.coalesce_reads = False
+        self.sg._in_flight.checked = 0
+        self.sg.find_one("Project", [["name", "is", "Big Buck"]])
+        self.assertEqual(0, self.sg._in_flight.checked)
+
+    def test_coalesce_reads_after_write(self):
+        """A read made after a write does not share a read sent before it"""
+        def _response(code):
+            return ((200, "OK"), {}, json.dumps({"results" : {"entities" : [
+                {"type" : "Shot", "id" : 1, "code" : code}], 
+                "paging_info" : {"entity_count" : 1}}}))
+        release = threading.Event()
+        calls = []
+        def _request(verb, path, body, headers):
+            calls.append(json.loads(body)["method_name"])
+            if len(calls) == 1:
+                release.wait()
+                return _response("old")
+            if calls[-1] == "update":
+                return ((200, "OK"), {}, json.dumps({"results" : {
+                    "type" : "Shot", "id" : 1, "code" : "new"}}))
+            return _response("new")
+        self.sg._http_request.side_effect = _request
+        
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.sg.find_one("Shot", [["id", "is", 1]], ["code"])))
+        thread.start()
+        try:
+            while not calls:
+                time.sleep(0.001)
+            self.sg.update("Shot", 1, {"code" : "new"})
+            self.assertEqual("new", self.sg.find_one("Shot", 
+                [["id", "is", 1]], ["code"], timeout=5)["code"])
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(["read", "update", "read"], calls)
+        self.assertEqual("old", results[0]["code"])
+
+    def test_coalesce_reads_timeout(self):
+        """A coalesced read is sent again when the call it joined fails 
+        within a shorter timeout"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Project", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        response = self.sg._http_request.return_value
+        self.sg.config.max_rpc_attempts = 1
+        release = threading.Event()
+        calls = []
+        def _request(*args):
+            calls.append(self.sg._time_left())
+            if len(calls) == 1:
+                release.wait()
+                raise socket.timeout("timed out")
+            return response
+        self.sg._http_request.side_effect = _request
+        
+        class _InFlight(dict):
+            def get(self, key):
+                value = dict.get(self, key)
+                if value is not None:
+                    release.set()
+                return value
+        self.sg._in_flight = _InFlight()
+        
+        errors = []
+        def _find():
+            try:
+                self.sg.find_one("Project", [], timeout=5)
+            except socket.timeout, e:
+                errors.append(e)
+        thread = threading.Thread(target=_find)
+        thread.start()
+        while not calls:
+            time.sleep(0.001)
+        result = self.sg.find_one("Project", [])
+        thread.join()
+        self.assertEqual({"type" : "Project", "id" : 1}, result)
+        self.assertEqual(1, len(errors))
+        self.assertEqual(2, len(calls))
+        self.assertEqual(None, calls[1])
+
+    def test_cache_misses(self):
+        """find_one() misses are cached until the entity type changes"""
+        self._mock_http({"results" : {"entities" : [], 
+            "paging_info" : {"entity_count" : 0}}})
+        self.sg.config.cache_misses_secs = 60
+        filters = [["path_cache", "is", "shots/010/comp.nk"]]
+        
+        self.assertEqual(None, self.sg.find_one("PublishedFile", filters))
+        self.assertEqual(None, self.sg.find_one("PublishedFile", filters))
+        self.assertEqual(1, self.sg._http_request.call_count)
+        self.sg.find_one("PublishedFile", filters, ["code"])
+        self.assertEqual(2, self.sg._http_request.call_count)
+        
+        self.sg.invalidate_cache("Shot")
+        self.sg.find_one("PublishedFile", filters)
+        self.assertEqual(2, self.sg._http_request.call_count)
+        self.sg.create("PublishedFile", {"code" : "comp"})
+        self.sg.find_one("PublishedFile", filters)
+        self.assertEqual(4, self.sg._http_request.call_count, 
+            "misses are read again after a create")
+        
+        self.sg.config.cache_misses_secs = 0
+        self.sg.find_one("PublishedFile", filters)
+        self.assertEqual(5, self.sg._http_request.call_count)
+
+    def test_result_cache_writes(self):
+        """Writes invalidate cached results for the entity type"""
+        self.sg.config.cache_results = True
+        self.sg._result_cache.set("shot", "result", tag="Shot")
+        self.sg._result_cache.set("asset", "result", tag="Asset")
+        self._mock_http({"results" : True})
+        self.sg.delete("Shot", 1)
+        self.assertEqual(None, self.sg._result_cache.get("shot"))
+        self.assertEqual("result", self.sg._result_cache.get("asset"))
+        
+        self._mock_http({"message" : "Go BANG", "exception" : True})
+        self.assertRaises(api.Fault, self.sg.batch, [{"request_type" : 
+            "delete", "entity_type" : "Asset", "entity_id" : 1}])
+        self.assertEqual(None, self.sg._result_cache.get("asset"))
+
+    def test_schema_cache(self):
+        """Schema reads are cached in memory and on disk"""
+        schema = {"Shot" : {"code" : {"data_type" : {"value" : "text"}}}}
+        self._mock_http({"results" : schema})
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.sg.config.cache_schema = True
+            self.sg.config.cache_dir = cache_dir
+            self.assertEqual(schema, self.sg.schema_read())
+            result = self.sg.schema_read()
+            self.assertEqual(schema, result)
+            self.assertEqual(1, self.sg._http_request.call_count)
+            result["Shot"] = None
+            self.assertEqual(schema, self.sg.schema_read(), 
+                "cached schema is not shared with callers")
+            
+            # a new client reads the cache file
+            self.sg._schema_cache.invalidate()
+            self.assertEqual(schema, self.sg.schema_read())
+            self.assertEqual(1, self.sg._http_request.call_count)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            
+            # the cache is not used for a different server version
+            self.sg._server_caps.version = (2, 5, 0)
+            self.sg.schema_read()
+            self.assertEqual(2, self.sg._http_request.call_count)
+            
+            self.sg.invalidate_schema_cache()
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            self.sg.schema_read()
+            self.assertEqual(3, self.sg._http_request.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_server_caps_cache(self):
+        """Server info is cached on disk for new clients"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.sg.config.cache_dir = cache_dir
+            self._mock_http({"version" : [2, 4, 0]})
+            self.sg._server_caps = None
+            self.assertEqual((2, 4, 0), self.sg.server_caps.version)
+            self.assertEqual(1, self.sg._http_request.call_count)
+            
+            sg = api.Shotgun(self.config.server_url, 
+                             self.config.script_name, 
+                             self.config.api_key, 
+                             cache_dir=cache_dir)
+            self.assertEqual((2, 4, 0), sg.server_caps.version)
+            self.assertTrue(sg._server_caps_cached)
+            
+            # a status that may pass only forgets the info in memory
+            self._mock_http("error", status=(503, "Service Unavailable"))
+            sg._http_request = self.sg._http_request
+            sg.config.retry_policy = api.RetryPolicy(budget=0)
+            self.assertRaises(api.ProtocolError, sg.info)
+            self.assertEqual(None, sg._server_caps)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            sg.server_caps
+            self.assertTrue(sg._server_caps_cached)
+            
+            # an http error forgets the cached info
+            self._mock_http("error", status=(500, "Internal Server Error"))
+            sg._http_request = self.sg._http_request
+            self.assertRaises(api.ProtocolError, sg.info)
+            self.assertEqual(None, sg._server_caps)
+            self.assertEqual([], os.listdir(cache_dir))
+            
+            self.sg.config.server_caps_cache_secs = -1
+            self._mock_http({"version" : [2, 5, 0]})
+            self.sg._write_cache_file(self.sg._server_info_file_name(), 
+                {"version" : [2, 4, 0]})
+            self.sg._server_caps = None
+            self.assertEqual((2, 5, 0), self.sg.server_caps.version, 
+                "expired info is read from the server")
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_transform_data(self):
         """Outbound data is transformed"""
         timestamp = time.time()
@@ -361,6 +1103,83 @@ class TestShotgunClient(base.MockTestBase):
         self.assertEqual("file:///foo/bar.jpg", modified["foo"]["url"])
         
         
+    def test_parse_records_thumbnails(self):
+        """Thumbnail urls are looked up concurrently and cached"""
+        def _thumb_url(entity_type, entity_id):
+            return "http://foo/%s/%s.jpg" % (entity_type, entity_id)
+        self.sg._build_thumb_url = mock.Mock(side_effect=_thumb_url)
+        self.sg.config.max_thumbnail_workers = 3
+        
+        records = [{"type" : "Shot", "id" : i % 4, "image" : "blah"} 
+            for i in range(8)]
+        self.sg._parse_records(records)
+        self.assertEqual([_thumb_url("Shot", i % 4) for i in range(8)], 
+            [rec["image"] for rec in records])
+        self.assertEqual(4, self.sg._build_thumb_url.call_count)
+        
+        self.sg._parse_records([{"type" : "Shot", "id" : 1, "image" : "x"}])
+        self.assertEqual(5, self.sg._build_thumb_url.call_count, 
+            "urls are not cached by default")
+        self.sg.config.thumbnail_cache_secs = 300
+        self.sg._parse_records([{"type" : "Shot", "id" : 1, "image" : "x"}])
+        self.sg._parse_records([{"type" : "Shot", "id" : 1, "image" : "x"}])
+        self.assertEqual(6, self.sg._build_thumb_url.call_count, 
+            "cached urls are not looked up again")
+        self.sg.config.thumbnail_cache_size = 1
+        self.sg._parse_records([{"type" : "Shot", "id" : 2, "image" : "x"}])
+        self.sg._parse_records([{"type" : "Shot", "id" : 1, "image" : "x"}])
+        self.assertEqual(8, self.sg._build_thumb_url.call_count, 
+            "the cache size is read from the config")
+        
+        self._mock_http({"results" : {"type" : "Shot", "id" : 1}})
+        self.sg.update("Shot", 1, {"code" : "bunny_010"})
+        self.assertEqual(_thumb_url("Shot", 1), 
+            self.sg._thumb_urls.get(("Shot", 1)))
+        self.sg.update("Shot", 1, {"image" : "/tmp/shot.jpg"})
+        self.assertEqual(None, self.sg._thumb_urls.get(("Shot", 1)), 
+            "changing the image removes the cached url")
+        
+        self.sg._build_thumb_url.side_effect = api.ShotgunError("Go BANG")
+        self.assertRaises(api.ShotgunError, self.sg._parse_records, 
+            [{"type" : "Shot", "id" : 99, "image" : "blah"}])
+
+    def test_parse_records_lazy_thumbnails(self):
+        """Thumbnail urls are looked up when they are used"""
+        url = "http://foo/files/0000/0000/0012/232/shot_thumb.jpg"
+        self.sg._build_thumb_url = mock.Mock(return_value=url)
+        self.sg.config.lazy_thumbnails = True
+        
+        records = self.sg._parse_records([
+            {"type" : "Shot", "id" : i, "image" : "blah"} for i in range(3)])
+        self.assertFalse(self.sg._build_thumb_url.called)
+        self.assertTrue(isinstance(records[0]["image"], api.ThumbnailUrl))
+        
+        self.assertEqual(url, str(records[1]["image"]))
+        self.assertEqual(url, records[1]["image"].resolve())
+        self.assertEqual(api.ThumbnailUrl(self.sg, "Shot", 1), 
+            records[1]["image"])
+        self.assertEqual(1, len(set([records[1]["image"], 
+            api.ThumbnailUrl(self.sg, "Shot", 1)])))
+        self.assertNotEqual(url, records[1]["image"])
+        self.sg._build_thumb_url.assert_called_once_with("Shot", 1)
+
+    def test_lru_cache(self):
+        """Cached values expire and least recently used are removed"""
+        cache = api.shotgun._LRUCache(max_entries=3)
+        for i in range(3):
+            cache.set(i, str(i))
+        cache.get(0)
+        cache.set(3, "3")
+        self.assertEqual(None, cache.get(1), "least recently used removed")
+        self.assertEqual("0", cache.get(0))
+        
+        cache.set("gone", "value", ttl=-1)
+        self.assertEqual("missing", cache.get("gone", "missing"))
+        cache.invalidate(0)
+        self.assertEqual(None, cache.get(0))
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+
     def test_thumb_url(self):
         """Thumbnail endpoint used to get thumbnail url"""
         
@@ -393,6 +1212,566 @@ class TestShotgunClient(base.MockTestBase):
         self.assertRaises(RuntimeError, self.sg._build_thumb_url, 
             "FakeAsset", 456)
 
+class TestFindPaging(base.MockTestBase):
+    '''Tests reading the pages of a find() with the rpc call mocked.'''
+
+    def setUp(self):
+        super(TestFindPaging, self).setUp()
+        self.sg.config.records_per_page = 2
+        self.entities = [{"type" : "Shot", "id" : i} for i in range(1, 8)]
+        self.read_pages = []
+        self.sg._call_rpc = mock.Mock(side_effect=self._read)
+
+    def _read(self, method, params, *args, **kws):
+        """Fake read rpc method returning pages from self.entities"""
+        paging = params["paging"]
+        self.read_pages.append(paging["current_page"])
+        entities = self.entities
+        for condition in params["filters"]["conditions"]:
+            if condition.get("relation") == "greater_than":
+                entities = [e for e in entities 
+                    if e["id"] > condition["values"][0]]
+        start = (paging["current_page"] - 1) * paging["entities_per_page"]
+        result = {
+            "entities" : entities[start:start + paging["entities_per_page"]]
+        }
+        if params["return_paging_info"]:
+            result["paging_info"] = {"entity_count" : len(self.entities)}
+        return result
+
+    def _read_pages(self):
+        return sorted(self.read_pages)
+
+    def test_serial_pages(self):
+        """Pages are read in turn by default"""
+        self.assertEqual(self.entities, self.sg.find("Shot", []))
+        self.assertEqual([1, 2, 3, 4], self._read_pages())
+
+    def test_parallel_pages(self):
+        """Remaining pages are read concurrently and joined in order"""
+        result = self.sg.find("Shot", [], max_parallel_pages=3)
+        self.assertEqual(self.entities, result)
+        self.assertEqual([1, 2, 3, 4], self._read_pages())
+        
+        self.sg.config.max_parallel_pages = 2
+        result = self.sg.find("Shot", [], limit=5)
+        self.assertEqual(self.entities[:5], result)
+
+    def test_parallel_page_error(self):
+        """Errors reading a page are raised from find()"""
+        def _read(method, params, *args, **kws):
+            if params["paging"]["current_page"] == 3:
+                raise api.Fault("Go BANG")
+            return self._read(method, params)
+        self.sg._call_rpc.side_effect = _read
+        self.assertRaises(api.Fault, self.sg.find, "Shot", [], 
+            max_parallel_pages=2)
+        self.assertRaises(ValueError, self.sg.find, "Shot", [], 
+            max_parallel_pages=0)
+
+    def test_find_iter(self):
+        """Records are returned page by page"""
+        records = self.sg.find_iter("Shot", [])
+        self.assertEqual([], self.read_pages, "no pages read until needed")
+        self.assertEqual(self.entities[0], records.next())
+        self.assertEqual([1], self.read_pages)
+        self.assertEqual(self.entities[1:], list(records))
+        self.assertEqual([1, 2, 3, 4], self._read_pages())
+        
+        self.read_pages = []
+        result = list(self.sg.find_iter("Shot", [], limit=3))
+        self.assertEqual(self.entities[:3], result)
+        self.assertEqual([1, 2], self._read_pages())
+        self.assertRaises(ValueError, self.sg.find_iter, "Shot", [], 
+            limit=-1)
+
+    def test_find_iter_prefetch(self):
+        """Pages are read ahead of the caller"""
+        records = self.sg.find_iter("Shot", [], prefetch_pages=1)
+        self.assertEqual(self.entities[0], records.next())
+        self.assertEqual(self.entities[1:], list(records))
+        self.assertEqual([1, 2, 3, 4], self._read_pages())
+        
+        def _read(method, params, *args, **kws):
+            if params["paging"]["current_page"] == 3:
+                raise api.Fault("Go BANG")
+            return self._read(method, params)
+        self.sg._call_rpc.side_effect = _read
+        records = self.sg.find_iter("Shot", [], prefetch_pages=2)
+        self.assertEqual(self.entities[:4], 
+            [records.next() for _ in range(4)])
+        self.assertRaises(api.Fault, records.next)
+        self.assertRaises(ValueError, self.sg.find_iter, "Shot", [], 
+            prefetch_pages=-1)
+
+    def test_keyset_pagination(self):
+        """Keyset pages are read after the last id"""
+        result = self.sg.find("Shot", [], pagination="keyset")
+        self.assertEqual(self.entities, result)
+        self.assertEqual([1, 1, 1, 1], self.read_pages)
+        args, _ = self.sg._call_rpc.call_args
+        self.assertEqual([{"field_name" : "id", "direction" : "asc"}], 
+            args[1]["sorts"])
+        self.assertEqual({"path" : "id", "relation" : "greater_than", 
+            "values" : [6]}, args[1]["filters"]["conditions"][-1])
+        
+        result = self.sg.find_iter("Shot", [], pagination="keyset", 
+            cursor=3, limit=3)
+        self.assertEqual(self.entities[3:6], list(result))
+        
+        self.assertRaises(ValueError, self.sg.find, "Shot", [], 
+            pagination="keyset", order=[{"field_name" : "code"}])
+        self.assertRaises(ValueError, self.sg.find, "Shot", [], 
+            pagination="keyset", page=2)
+        self.assertRaises(ValueError, self.sg.find, "Shot", [], 
+            pagination="bogus")
+
+    def test_add_filter_condition(self):
+        """Conditions are added to translated filters"""
+        filters = api.shotgun._translate_filters([["code", "is", "a"]], "any")
+        result = api.shotgun._add_filter_condition(filters, 
+            ["id", "greater_than", 5])
+        self.assertEqual("and", result["logical_operator"])
+        self.assertEqual(filters, result["conditions"][0])
+
+    def test_adaptive_paging(self):
+        """Page size is tuned per entity type and fields"""
+        config = self.sg.config
+        config.records_per_page = 100
+        config.min_records_per_page = 10
+        config.max_records_per_page = 400
+        config.target_page_secs = 1.0
+        sizer = api.shotgun._PageSizer(config)
+        params = {"type" : "Shot", "return_fields" : ["code", "id"]}
+        other = {"type" : "Shot", "return_fields" : ["id"]}
+        
+        # 100 entities in 4 secs, target is 25 entities
+        sizer.record(params, 100, 4.0, 1000)
+        self.assertEqual(62, sizer.page_size(params))
+        self.assertEqual(100, sizer.page_size(other))
+        # fast pages grow at most twice as big
+        sizer.record(other, 100, 0.01, 1000)
+        self.assertEqual(200, sizer.page_size(other))
+        # large pages are limited by bytes
+        config.target_page_bytes = 1000
+        sizer.record(other, 200, 0.01, 20000)
+        self.assertEqual(105, sizer.page_size(other))
+        
+        config.adaptive_paging = True
+        self.sg._page_sizer._sizes[("Shot", ("id",))] = 3
+        self.assertEqual(self.entities, self.sg.find("Shot", []))
+        self.assertEqual([1, 2, 3], self._read_pages())
+        
+        # pages asked for by number keep the configured size
+        config.records_per_page = 2
+        self.read_pages = []
+        self.assertEqual(self.entities[4:6], self.sg.find("Shot", [], page=3))
+        self.assertEqual([3], self._read_pages())
+        self.assertEqual(self.entities[2:4], 
+            self.sg.find("Shot", [], limit=4, page=2))
+
+    def test_find_many(self):
+        """Queries are run concurrently and errors collected"""
+        queries = [
+            {"entity_type" : "Shot", "filters" : [], "limit" : 3},
+            ("Shot", [], None, None, None, -1),
+            ("Shot", []),
+        ]
+        self.sg.config.max_concurrent_queries = 2
+        filtered, error, everything = self.sg.find_many(queries)
+        self.assertEqual(self.entities[:3], filtered)
+        self.assertTrue(isinstance(error, ValueError))
+        self.assertEqual(self.entities, everything)
+        self.assertEqual([], self.sg.find_many([]))
+        self.assertRaises(api.ShotgunError, self.sg.find_many, "Shot")
+
+class TestConnectionPool(unittest.TestCase):
+    '''Tests for the pool of connections shared between threads.'''
+
+    def setUp(self):
+        self.config = api.shotgun._Config()
+        self.config.connection_pool_size = 2
+        self.created = []
+        self.pool = api.shotgun._ConnectionPool(self._factory, self.config)
+
+    def _factory(self):
+        http = mock.Mock(spec=httplib2.Http)
+        http.connections = dict()
+        self.created.append(http)
+        return http
+
+    def test_checkout_checkin(self):
+        """Connections are reused and limited to the pool size"""
+        first = self.pool.checkout()
+        second = self.pool.checkout()
+        self.assertEqual(2, self.pool.size)
+        self.pool.checkin(first)
+        self.assertTrue(first is self.pool.checkout())
+        
+        self.config.connection_pool_timeout = 0.01
+        self.assertRaises(api.CallTimeoutError, self.pool.checkout)
+        
+        self.pool.discard(second)
+        self.assertEqual(1, self.pool.size)
+        self.assertTrue(self.pool.checkout() not in (first, second))
+
+    def test_idle_eviction(self):
+        """Idle connections are closed"""
+        conn = mock.Mock()
+        http = self.pool.checkout()
+        http.connections["conn"] = conn
+        self.pool.checkin(http)
+        self.config.connection_idle_secs = 0
+        time.sleep(0.01)
+        self.assertTrue(self.pool.checkout() is not http)
+        self.assertTrue(conn.close.called)
+        self.assertEqual(1, self.pool.size)
+
+    def test_shared_between_threads(self):
+        """Threads wait for a free connection"""
+        in_use = []
+        def _use():
+            http = self.pool.checkout()
+            self.assertFalse(http in in_use)
+            in_use.append(http)
+            time.sleep(0.01)
+            in_use.remove(http)
+            self.pool.checkin(http)
+        threads = [threading.Thread(target=_use) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(2, len(self.created))
+
+class TestAsyncShotgun(base.MockTestBase):
+    '''Tests for running client calls on background threads.'''
+
+    def setUp(self):
+        super(TestAsyncShotgun, self).setUp()
+        self.async_sg = api.AsyncShotgun(self.sg, max_workers=2)
+
+    def tearDown(self):
+        self.async_sg.close()
+        super(TestAsyncShotgun, self).tearDown()
+
+    def test_result(self):
+        """Calls return futures for their results"""
+        self._mock_http({"results" : {"entities" : [{"type" : "Shot", 
+            "id" : 1}], "paging_info" : {"entity_count" : 1}}})
+        future = self.async_sg.find("Shot", [])
+        self.assertEqual([{"type" : "Shot", "id" : 1}], future.result(5))
+        self.assertTrue(future.done())
+        self.assertEqual(None, future.exception())
+        self._assert_http_method("read", None)
+        self.assertEqual("find", api.AsyncShotgun.find.__name__)
+        self.assertEqual("shotgun_api3.shotgun", 
+            api.AsyncShotgun.find.__module__)
+
+    def test_exception(self):
+        """Exceptions are raised from result()"""
+        self._mock_http({"message" : "Go BANG", "exception" : True})
+        future = self.async_sg.delete("Shot", 1)
+        self.assertRaises(api.Fault, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), api.Fault))
+
+    def test_callback(self):
+        """Callbacks are called when the call finishes"""
+        start = threading.Event()
+        called = threading.Event()
+        def _call(x):
+            start.wait(5)
+            return x * 2
+        future = self.async_sg.submit(_call, 21)
+        future.add_done_callback(lambda f: called.set())
+        self.assertFalse(called.isSet())
+        start.set()
+        self.assertEqual(42, future.result(5))
+        called.wait(5)
+        self.assertTrue(called.isSet())
+        
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual([future], done)
+
+class TestEventCacheInvalidator(base.MockTestBase):
+    '''Tests invalidating cached data from the event log.'''
+
+    def setUp(self):
+        super(TestEventCacheInvalidator, self).setUp()
+        self.events = [
+            {"type" : "EventLogEntry", "id" : 10, 
+             "event_type" : "Shotgun_Shot_Change", "attribute_name" : "image",
+             "entity" : {"type" : "Shot", "id" : 3}, "meta" : {}},
+            {"type" : "EventLogEntry", "id" : 11, 
+             "event_type" : "Shotgun_CustomEntity01_Retirement", 
+             "attribute_name" : None, "entity" : None, "meta" : None},
+        ]
+        self.sg._call_rpc = mock.Mock(side_effect=self._read)
+        self.invalidator = api.EventCacheInvalidator(self.sg, batch_size=10)
+        self.invalidator.cursor = 9
+        for key, tag in [("shot", "Shot"), ("asset", "Asset"), 
+            ("custom", "CustomEntity01")]:
+            self.sg._result_cache.set(key, "result", tag=tag)
+        self.sg._thumb_urls.set(("Shot", 3), "url")
+
+    def _read(self, method, params, *args, **kws):
+        cursor = 0
+        for condition in params["filters"]["conditions"]:
+            cursor = condition["values"][0]
+        events = [e for e in self.events if e["id"] > cursor]
+        if params.get("sorts", [{}])[0].get("direction") == "desc":
+            events.reverse()
+        return {"entities" : events}
+
+    def test_poll(self):
+        """Events invalidate cached results and thumbnails"""
+        self.assertEqual(2, self.invalidator.poll())
+        self.assertEqual(11, self.invalidator.cursor)
+        self.assertEqual(None, self.sg._result_cache.get("shot"))
+        self.assertEqual(None, self.sg._result_cache.get("custom"))
+        self.assertEqual("result", self.sg._result_cache.get("asset"))
+        self.assertEqual(None, self.sg._thumb_urls.get(("Shot", 3)))
+        self.assertEqual(0, self.invalidator.poll())
+
+    def test_first_poll(self):
+        """The first poll starts from the latest event"""
+        invalidator = api.EventCacheInvalidator(self.sg)
+        self.assertEqual(0, invalidator.poll())
+        self.assertEqual(11, invalidator.cursor)
+        self.assertEqual(0, len(self.sg._result_cache))
+        self.assertEqual(None, self.sg._thumb_urls.get(("Shot", 3)))
+
+    def test_start_stop(self):
+        """Following events starts from the latest event"""
+        self.invalidator.start()
+        self.invalidator.stop()
+        self.assertEqual(11, self.invalidator.cursor)
+        self.assertEqual(0, len(self.sg._result_cache))
+
+class TestEventStream(base.MockTestBase):
+    '''Tests following the event log.'''
+
+    def setUp(self):
+        super(TestEventStream, self).setUp()
+        self.events = [{"type" : "EventLogEntry", "id" : i} 
+            for i in range(10, 20)]
+        self.sg._call_rpc = mock.Mock(side_effect=self._read)
+        self.cursor_dir = tempfile.mkdtemp()
+        self.cursor_path = os.path.join(self.cursor_dir, "cursor")
+
+    def tearDown(self):
+        shutil.rmtree(self.cursor_dir)
+        super(TestEventStream, self).tearDown()
+
+    _read = TestEventCacheInvalidator._read.im_func
+
+    def test_batches(self):
+        """Batches grow while behind and shrink once caught up"""
+        stream = api.EventStream(self.sg, cursor=9, min_batch=2, max_batch=4)
+        self.assertEqual([10, 11], [e["id"] for e in stream.read_batch()])
+        self.assertEqual(4, stream.batch_size)
+        stream.cursor = 11
+        self.assertEqual(4, len(stream.read_batch()))
+        stream.cursor = 17
+        self.assertEqual(2, len(stream.read_batch()))
+        stream.cursor = 19
+        self.assertEqual([], stream.read_batch())
+        self.assertEqual(2, stream.batch_size)
+
+    def test_poll_wait(self):
+        """The stream only waits before reading again once it has caught up"""
+        stream = api.EventStream(self.sg, cursor=9, min_batch=3, max_batch=4,
+            min_poll_secs=0.5)
+        waits = []
+        class _Stop(object):
+            def isSet(self):
+                return len(waits) == 2
+            def wait(self, secs):
+                waits.append((stream.cursor, secs))
+        stream._stop = _Stop()
+        self.assertEqual(range(10, 20), [e["id"] for e in stream])
+        self.assertEqual([(19, 0.5), (19, 0.5)], waits)
+
+    def test_run_checkpoint(self):
+        """Events are handled in order and the cursor is saved"""
+        stream = api.EventStream(self.sg, cursor_path=self.cursor_path, 
+            min_poll_secs=0.01)
+        self.assertEqual(19, stream.cursor, "starts at the latest event")
+        
+        stream = api.EventStream(self.sg, cursor=9, 
+            cursor_path=self.cursor_path, min_poll_secs=0.01)
+        handled = []
+        def _handler(event):
+            if event["id"] == 15:
+                raise ValueError("Go BANG")
+            handled.append(event["id"])
+        self.assertRaises(ValueError, stream.run, _handler)
+        self.assertEqual(range(10, 15), handled)
+        self.assertEqual("14", open(self.cursor_path).read())
+        
+        stream = api.EventStream(self.sg, cursor_path=self.cursor_path, 
+            min_poll_secs=0.01)
+        self.assertEqual(14, stream.cursor, "cursor is read from the file")
+        def _handler(event):
+            handled.append(event["id"])
+            if event["id"] == 19:
+                stream.stop()
+        stream.run(_handler)
+        self.assertEqual(range(10, 20), handled)
+        self.assertEqual("19", open(self.cursor_path).read())
+
+class TestReplica(base.MockTestBase):
+    '''Tests the local replica of entities.'''
+
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        self.server = {
+            "Shot" : [
+                {"type" : "Shot", "id" : 1, "code" : "bunny_010", 
+                 "sg_status_list" : "ip", "tags" : [],
+                 "project" : {"type" : "Project", "id" : 1, "name" : "p"}},
+                {"type" : "Shot", "id" : 2, "code" : "bunny_020", 
+                 "sg_status_list" : "fin", "project" : None,
+                 "tags" : [{"type" : "Tag", "id" : 5, "name" : "hero"}]},
+                {"type" : "Shot", "id" : 3, "code" : "Cat_010", 
+                 "sg_status_list" : None, "project" : None, "tags" : []},
+            ],
+            "EventLogEntry" : [{"type" : "EventLogEntry", "id" : 7}],
+        }
+        self.sg._call_rpc = mock.Mock(side_effect=self._read)
+        self.db_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.db_dir, "replica.db")
+        self.fields = {"Shot" : ["code", "sg_status_list", "project", "tags"]}
+        self.replica = api.Replica(self.sg, self.db_path, self.fields)
+
+    def tearDown(self):
+        self.replica.close()
+        shutil.rmtree(self.db_dir)
+        super(TestReplica, self).tearDown()
+
+    def _read(self, method, params, *args, **kws):
+        records = self.server[params["type"]]
+        for condition in params["filters"]["conditions"]:
+            path = condition["path"]
+            value = condition["values"][0]
+            if condition["relation"] == "in":
+                records = [r for r in records if r.get(path) in value]
+            elif condition["relation"] == "greater_than":
+                records = [r for r in records if r.get(path) > value]
+        if params.get("sorts", [{}])[0].get("direction") == "desc":
+            records = list(reversed(records))
+        limit = params["paging"]["entities_per_page"]
+        return {"entities" : [dict(r) for r in records[:limit]],
+                "paging_info" : {"entity_count" : len(records)}}
+
+    def _ids(self, filters, **kws):
+        return [r["id"] for r in self.replica.find("Shot", filters, **kws)]
+
+    def test_find(self):
+        """Queries are answered from the replica"""
+        self.assertEqual(3, self.replica.sync())
+        self.sg._call_rpc.reset_mock()
+        
+        self.assertEqual([{"type" : "Shot", "id" : 1, "code" : "bunny_010"}],
+            self.replica.find("Shot", [["sg_status_list", "is", "ip"]], 
+            ["code"]))
+        self.assertEqual([2, 1], self._ids([["code", "starts_with", "BUN"]], 
+            order=[{"field_name" : "code", "direction" : "desc"}]))
+        self.assertEqual([2, 3], self._ids([["sg_status_list", "is", "fin"], 
+            ["sg_status_list", "is", None]], filter_operator="any"))
+        self.assertEqual([2, 3], self._ids([["sg_status_list", "is_not", 
+            "ip"]]))
+        self.assertEqual([1], self._ids([["project", "is", 
+            {"type" : "Project", "id" : 1}]]))
+        self.assertEqual([2], self._ids([["tags", "is", 
+            {"type" : "Tag", "id" : 5}]]))
+        self.assertEqual([1, 3], self._ids([["tags", "is", None]]))
+        self.assertEqual([1, 3], self._ids([["id", "in", [1, 3]]]))
+        self.assertEqual([2], self._ids([["id", "not_in", 1, 3]]))
+        self.assertEqual([], self._ids([["code", "contains", "%"]]))
+        self.assertEqual([2], self._ids([], limit=1, page=2))
+        self.sg.config.records_per_page = 2
+        self.assertEqual([1, 2], self._ids([], page=1))
+        self.assertEqual([3], self._ids([], limit=5, page=2), 
+            "pages are no longer than records_per_page, as on the server")
+        self.sg.config.records_per_page = 500
+        self.assertEqual([2], self._ids([["tags", "name_contains", "HER"]]))
+        self.assertEqual({"type" : "Shot", "id" : 2, "tags" : 
+            [{"type" : "Tag", "id" : 5, "name" : "hero"}]}, 
+            self.replica.find_one("Shot", [["code", "ends_with", "020"]], 
+            ["tags"]))
+        self.assertFalse(self.sg._call_rpc.called)
+        
+        self.replica.find("Shot", [], ["description"])
+        self.assertTrue(self.sg._call_rpc.called, 
+            "fields not replicated are read from the server")
+
+    def test_sync_events(self):
+        """Changed entities are read again using the event log"""
+        self.replica.sync()
+        shots = self.server["Shot"]
+        shots[0]["sg_status_list"] = "fin"
+        del shots[2]
+        shots.append({"type" : "Shot", "id" : 4, "code" : "Cat_020", 
+            "sg_status_list" : "wtg", "project" : None, "tags" : []})
+        self.server["EventLogEntry"].extend([
+            {"type" : "EventLogEntry", "id" : 8, 
+             "event_type" : "Shotgun_Shot_Change", 
+             "entity" : {"type" : "Shot", "id" : 1}, "meta" : {}},
+            {"type" : "EventLogEntry", "id" : 9, 
+             "event_type" : "Shotgun_Shot_Retirement", 
+             "entity" : None, "meta" : {"entity_id" : 3}},
+            {"type" : "EventLogEntry", "id" : 10, 
+             "event_type" : "Shotgun_Shot_New", 
+             "entity" : {"type" : "Shot", "id" : 4}, "meta" : {}},
+        ])
+        self.assertEqual(3, self.replica.sync())
+        self.assertEqual([1, 2], self._ids([["sg_status_list", "is", "fin"]]))
+        self.assertEqual([1, 2, 4], self._ids([]))
+        self.assertEqual(0, self.replica.sync())
+        
+        self.replica.close()
+        self.replica = api.Replica(self.sg, self.db_path, self.fields)
+        self.sg._call_rpc.reset_mock()
+        self.assertEqual([1, 2, 4], self._ids([]))
+        self.assertFalse(self.sg._call_rpc.called, "replica is saved")
+        
+        self.replica.close()
+        self.replica = api.Replica(self.sg, self.db_path, {"Shot" : ["code"]})
+        self._ids([])
+        self.assertTrue(self.sg._call_rpc.called, 
+            "replica is cleared when the fields change")
+
+    def test_find_during_sync(self):
+        """Queries are answered while a sync is reading from the server"""
+        self.replica.sync()
+        found = []
+        def _read(method, params, *args, **kws):
+            if params["type"] == "EventLogEntry" and not found:
+                thread = threading.Thread(target=lambda: found.append(
+                    self._ids([])))
+                thread.start()
+                thread.join(5)
+            return self._read(method, params, *args, **kws)
+        self.sg._call_rpc.side_effect = _read
+        self.replica.sync()
+        self.assertEqual([[1, 2, 3]], found)
+
+    def test_start_using_events(self):
+        """A replica synced without events is synced again to use them"""
+        self.fields["Shot"].append("updated_at")
+        self.replica.close()
+        self.replica = api.Replica(self.sg, self.db_path, self.fields, 
+            use_events=False)
+        self.assertEqual(3, self.replica.sync())
+        self.replica.close()
+        
+        self.replica = api.Replica(self.sg, self.db_path, self.fields)
+        self.assertEqual(3, self.replica.sync())
+        self.assertEqual(0, self.replica.sync())
+        self.assertEqual([1, 2, 3], self._ids([]))
+
 class TestShotgunClientInterface(base.MockTestBase):
     '''Tests expected interface for shotgun module and client'''
     def test_client_interface(self):
@@ -1,4 +1,5 @@
 #! /opt/local/bin/python
+import datetime
 import unittest
 from mock import patch, Mock
 import shotgun_api3 as api
@@ -176,6 +177,85 @@ class TestClientCapabilities(unittest.TestCase):
         client_caps = api.shotgun.ClientCapabilities()
         self.assertEquals(client_caps.py_version, expected_py_version)
         
+class TestMatchFilters(unittest.TestCase):
+    '''Test case for evaluating filters on records.'''
+
+    def setUp(self):
+        self.now = datetime.datetime(2012, 3, 14, 12, 0)
+        self.record = {
+            "type" : "Shot", "id" : 3, "code" : "Bunny_010", "cut_in" : 10,
+            "sg_status_list" : None, "due_date" : "2012-03-16",
+            "updated_at" : datetime.datetime(2012, 3, 13, 9, 30),
+            "project" : {"type" : "Project", "id" : 1, "name" : "Big Buck"},
+            "tags" : [{"type" : "Tag", "id" : 5, "name" : "hero"}],
+            "sg_sequence.Sequence.code" : "bunny",
+        }
+
+    def _match(self, *filters, **kws):
+        filters = api.shotgun._translate_filters(filters, 
+            kws.get("filter_operator"))
+        return api.shotgun._match_filters(filters, self.record, self.now)
+
+    def test_relations(self):
+        '''test_relations tests the relations on simple fields.'''
+        self.assertTrue(self._match(["code", "is", "Bunny_010"]))
+        self.assertFalse(self._match(["code", "is_not", "Bunny_010"]))
+        self.assertTrue(self._match(["sg_status_list", "is", None]))
+        self.assertTrue(self._match(["cut_in", "in", [1, 10]]))
+        self.assertTrue(self._match(["cut_in", "not_in", 1, 2]))
+        self.assertTrue(self._match(["cut_in", "less_than", 11]))
+        self.assertFalse(self._match(["cut_in", "greater_than", 10]))
+        self.assertTrue(self._match(["cut_in", "between", 10, 20]))
+        self.assertFalse(self._match(["sg_status_list", "less_than", 1]))
+        self.assertTrue(self._match(["code", "contains", "NY_0"]))
+        self.assertTrue(self._match(["code", "starts_with", "bun"]))
+        self.assertTrue(self._match(["code", "not_contains", "cat"]))
+        self.assertTrue(self._match(["code", "is", "x"], 
+            ["cut_in", "is", 10], filter_operator="any"))
+        self.assertFalse(self._match(["code", "is", "x"], 
+            ["cut_in", "is", 10]))
+        self.assertRaises(api.ShotgunError, self._match, 
+            ["code", "sounds_like", "x"])
+        self.assertRaises(api.ShotgunError, self._match, 
+            ["description", "is", "x"])
+
+    def test_entities(self):
+        '''test_entities tests filters on linked entities.'''
+        self.assertTrue(self._match(["project", "is", 
+            {"type" : "Project", "id" : 1}]))
+        self.assertFalse(self._match(["project", "is", 
+            {"type" : "Asset", "id" : 1}]))
+        self.assertTrue(self._match(["project", "type_is", "Project"]))
+        self.assertTrue(self._match(["project", "name_contains", "buck"]))
+        self.assertTrue(self._match(["project.Project.name", "is", 
+            "Big Buck"]))
+        self.assertTrue(self._match(["sg_sequence.Sequence.code", "is", 
+            "bunny"]))
+        self.assertTrue(self._match(["tags", "is", 
+            {"type" : "Tag", "id" : 5}]))
+        self.assertFalse(self._match(["tags", "is_not", 
+            {"type" : "Tag", "id" : 5}]))
+        self.assertFalse(self._match(["tags", "is", None]))
+        self.assertTrue(self._match(["tags", "name_is", "HERO"]))
+
+    def test_dates(self):
+        '''test_dates tests filters on dates and date times.'''
+        self.assertTrue(self._match(["due_date", "is", 
+            datetime.date(2012, 3, 16)]))
+        self.assertTrue(self._match(["due_date", "greater_than", 
+            datetime.date(2012, 3, 15)]))
+        self.assertTrue(self._match(["updated_at", "in_last", 2, "DAY"]))
+        self.assertFalse(self._match(["updated_at", "in_last", 1, "DAY"]))
+        self.assertTrue(self._match(["due_date", "in_next", 1, "WEEK"]))
+        self.assertTrue(self._match(["due_date", "not_in_next", 1, "DAY"]))
+        self.assertTrue(self._match(["updated_at", "in_calendar_day", -1]))
+        self.assertTrue(self._match(["due_date", "in_calendar_week", 0]))
+        self.assertTrue(self._match(["due_date", "in_calendar_month", 0]))
+        self.assertFalse(self._match(["due_date", "in_calendar_year", 1]))
+        self.assertEqual(datetime.datetime(2012, 2, 29), 
+            api.shotgun._shift_time(datetime.datetime(2012, 3, 31), -1, 
+            "MONTH"))
+
 if __name__ == '__main__':
     unittest.main()
 